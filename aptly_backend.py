@@ -0,0 +1,431 @@
+import json
+import os
+import socket
+import subprocess
+import threading
+import httplib
+import urllib
+import urlparse
+
+import debversion
+
+
+class BackendError(Exception):
+    pass
+
+
+def parse_search(lines):
+    """
+    Parse `aptly repo search` output line by line
+    :param lines: Iterable of lines 'name_version_arch'
+    :return: Generator, items as tuple (name, version, arch)
+    """
+    for line in lines:
+        raw_pack = line.strip().split("_")
+        if len(raw_pack) != 3:
+            continue
+        yield raw_pack[0], raw_pack[1], raw_pack[2]
+
+
+def _join_archs(archs, more):
+    for arch in more.split(','):
+        if arch not in archs:
+            archs.append(arch)
+    return archs
+
+
+def group_packages(entries):
+    """
+    Group versions of consecutive entries with the same package name.
+    aptly lists packages ordered by name, so every package is yielded once as soon as
+    its last version is read. If entries are not ordered, package may be yielded again
+    :param entries: Iterable of tuples (name, version, arch)
+    :return: Generator, items as tuple (name, archs, sorted versions[], version_archs[]). archs is comma
+    separated list of all architectures package has, versions are unique, version_archs are comma separated
+    architectures of each version, in order of versions
+    """
+    packg, archs, versions = None, [], {}
+    for name, version, arch in entries:
+        if name != packg:
+            if versions:
+                yield _grouped(packg, archs, versions)
+            packg, archs, versions = name, [], {}
+        if arch not in archs:
+            archs.append(arch)
+        version_archs = versions.setdefault(version, [])
+        if arch not in version_archs:
+            version_archs.append(arch)
+    if versions:
+        yield _grouped(packg, archs, versions)
+
+
+def _grouped(packg, archs, versions):
+    """
+    :param versions: dict { version: [arch] }
+    :return: Tuple (name, archs, sorted versions[], version_archs[]), as yielded by group_packages
+    """
+    ordered = debversion.sort_versions(list(versions))
+    return packg, ','.join(archs), ordered, [','.join(versions[version]) for version in ordered]
+
+
+def read_packages(lines):
+    """
+    Build package map from `aptly repo search` output
+    :param lines: Iterable of lines 'name_version_arch'
+    :return: dict { package_name: (archs, sorted versions[], version_archs[]) }, archs are comma separated,
+    version_archs are architectures of each version, in order of versions
+    """
+    packages = {}
+    for packg, archs, versions, version_archs in group_packages(parse_search(lines)):
+        if packg in packages:
+            known_archs, known_versions, known_version_archs = packages[packg]
+            merged = dict((version, arch.split(',')) for version, arch in zip(known_versions, known_version_archs))
+            for version, arch in zip(versions, version_archs):
+                merged[version] = _join_archs(merged.get(version, []), arch)
+            _, archs, versions, version_archs = _grouped(packg, _join_archs(known_archs.split(','), archs), merged)
+        packages[packg] = (archs, versions, version_archs)
+    return packages
+
+
+def _iter_json_strings(chunks):
+    """
+    Incrementally read strings out of JSON array of strings
+    :param chunks: Iterable of raw response parts
+    :return: Generator of strings
+    """
+    buf = ''
+    for chunk in chunks:
+        buf += chunk
+        start = 0
+        while True:
+            begin = buf.find('"', start)
+            if begin < 0:
+                start = len(buf)
+                break
+            end = begin + 1
+            while True:
+                end = buf.find('"', end)
+                if end < 0 or buf[end - 1] != '\\':
+                    break
+                end += 1
+            if end < 0:
+                start = begin
+                break
+            yield json.loads(buf[begin:end + 1])
+            start = end + 1
+        buf = buf[start:]
+
+
+class CliBackend(object):
+    """
+    Talks to aptly by running `aptly` binary. Every call reopens and locks aptly DB,
+    so calls from different threads are serialized
+    """
+    name = 'cli'
+
+    def __init__(self, metrics=None):
+        self._lock = threading.Lock()
+        self._metrics = metrics
+
+    def _count(self, op):
+        if self._metrics:
+            self._metrics.count('aptly_calls', label=op)
+
+    def search(self, repo):
+        """
+        Stream all packages in repo
+        :param repo: Repo name
+        :return: Generator of lines 'name_version_arch'
+        """
+        # Using 'Name' to search for all valid packages. As per https://www.aptly.info/doc/feature/query/
+        cmd = ['aptly', 'repo', 'search', repo, 'Name']
+        self._count('search')
+        with self._lock:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+            try:
+                for line in iter(proc.stdout.readline, ''):
+                    yield line
+            finally:
+                proc.stdout.close()
+                code = proc.wait()
+        if code:
+            raise subprocess.CalledProcessError(code, cmd)
+
+    def remove(self, repo, packages):
+        """
+        Remove packages from repo in one aptly call
+        :param repo: Repo name
+        :param packages: List of tuples (name, version)
+        :return: List of tuples (name, version) that failed to be removed
+        """
+        queries = ["{0} (= {1})".format(name, version) for name, version in packages]
+        self._count('remove')
+        with self._lock:
+            code = subprocess.call(['aptly', 'repo', 'remove', repo] + queries)
+        if code == 0:
+            return []
+        if len(packages) == 1:
+            return list(packages)
+        # Find out which of packages failed
+        return [package for package in packages if self.remove(repo, [package])]
+
+    def publish(self, distribution, prefix=None):
+        cmd = ['aptly', 'publish', 'update', distribution]
+        if prefix:
+            cmd.append(prefix)
+        self._count('publish')
+        with self._lock:
+            return subprocess.call(cmd) == 0
+
+    def db_cleanup(self):
+        self._count('db_cleanup')
+        try:
+            with self._lock:
+                subprocess.check_output(['aptly', 'db', 'cleanup', '-verbose'])
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise BackendError(str(e))
+
+
+class ConnectionPool(object):
+    """
+    Keep-alive HTTP connections to one host, reused between requests
+    """
+
+    def __init__(self, url, size=4, timeout=300):
+        parsed = urlparse.urlparse(url)
+        self._conn_class = httplib.HTTPSConnection if parsed.scheme == 'https' else httplib.HTTPConnection
+        self._host = parsed.netloc
+        self._timeout = timeout
+        self._size = size
+        self._free = []
+        self._lock = threading.Lock()
+
+    def _get(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return self._conn_class(self._host, timeout=self._timeout)
+
+    def _put(self, conn):
+        with self._lock:
+            if len(self._free) < self._size:
+                self._free.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self._lock:
+            free, self._free = self._free, []
+        for conn in free:
+            conn.close()
+
+    def _response(self, method, path, body, headers):
+        # Retry once on stale keep-alive connection
+        for attempt in (0, 1):
+            conn = self._get()
+            try:
+                conn.request(method, path, body, headers or {})
+                return conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if attempt:
+                    raise
+
+    def _release(self, conn, resp):
+        if resp.getheader('connection', '').lower() == 'close':
+            conn.close()
+        else:
+            self._put(conn)
+
+    def request(self, method, path, body=None, headers=None):
+        """
+        Do request
+        :return: Tuple (status, body)
+        """
+        conn, resp = self._response(method, path, body, headers)
+        try:
+            data = resp.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            raise
+        self._release(conn, resp)
+        return resp.status, data
+
+    def stream(self, method, path, body=None, headers=None, chunk_size=64 * 1024):
+        """
+        Do request, reading response by chunks
+        :return: Tuple (status, generator of chunks)
+        """
+        conn, resp = self._response(method, path, body, headers)
+
+        def chunks():
+            try:
+                for chunk in iter(lambda: resp.read(chunk_size), ''):
+                    yield chunk
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                raise
+            self._release(conn, resp)
+        return resp.status, chunks()
+
+
+class ApiBackend(object):
+    """
+    Talks to `aptly api serve` over REST API. aptly serializes writes on its side,
+    so calls may be done from several threads
+    """
+    name = 'api'
+
+    def __init__(self, url, pool_size=4, metrics=None):
+        self._metrics = metrics
+        self._base = urlparse.urlparse(url).path.rstrip('/')
+        self._pool = ConnectionPool(url, pool_size)
+
+    def _count(self, op):
+        if self._metrics:
+            self._metrics.count('aptly_calls', label=op)
+
+    def _call(self, method, path, payload=None, query=None):
+        self._count(method.lower())
+        url = self._base + path
+        if query:
+            url += '?' + urllib.urlencode(query)
+        body = json.dumps(payload) if payload is not None else None
+        status, data = self._pool.request(method, url, body, {'Content-Type': 'application/json'})
+        if status >= 400:
+            raise BackendError('{0} {1}: {2} {3}'.format(method, path, status, data.strip()))
+        return json.loads(data) if data else None
+
+    @staticmethod
+    def _quote(name):
+        return urllib.quote(name, safe='')
+
+    def ping(self):
+        return self._call('GET', '/version')
+
+    def close(self):
+        self._pool.close()
+
+    def search(self, repo):
+        path = '/repos/{0}/packages'.format(self._quote(repo))
+        self._count('get')
+        status, chunks = self._pool.stream('GET', self._base + path + '?' + urllib.urlencode({'q': 'Name'}))
+        if status >= 400:
+            raise BackendError('GET {0}: {1} {2}'.format(path, status, ''.join(chunks).strip()))
+        for ref in _iter_json_strings(chunks):
+            # ref format: 'P<arch> <name> <version> <hash>'
+            arch, name, version = ref.split(' ')[:3]
+            yield '_'.join([name, version, arch[1:]])
+
+    def _delete_refs(self, repo, refs):
+        self._call('DELETE', '/repos/{0}/packages'.format(self._quote(repo)), {'PackageRefs': refs})
+
+    def _find_refs(self, repo, packages):
+        """
+        Get package refs of packages with one query
+        :param repo: Repo name
+        :param packages: List of tuples (name, version)
+        :return: dict { (name, version): [ref] }, packages that were not found are missing
+        """
+        query = ' | '.join("{0} (= {1})".format(name, version) for name, version in packages)
+        try:
+            found = self._call('GET', '/repos/{0}/packages'.format(self._quote(repo)), query={'q': query})
+        except BackendError:
+            if len(packages) == 1:
+                return {}
+            # Find out which of packages broke query
+            refs = {}
+            for package in packages:
+                refs.update(self._find_refs(repo, [package]))
+            return refs
+
+        wanted = set(tuple(package) for package in packages)
+        refs = {}
+        for ref in found or []:
+            # ref format: 'P<arch> <name> <version> <hash>'
+            package = tuple(ref.split(' ')[1:3])
+            if package in wanted:
+                refs.setdefault(package, []).append(ref)
+        return refs
+
+    def remove(self, repo, packages):
+        refs = self._find_refs(repo, packages)
+        failed = [package for package in packages if tuple(package) not in refs]
+
+        if not refs:
+            return failed
+        try:
+            self._delete_refs(repo, [ref for refs_of_package in refs.values() for ref in refs_of_package])
+        except BackendError:
+            # Find out which of packages failed
+            for package, package_refs in refs.iteritems():
+                try:
+                    self._delete_refs(repo, package_refs)
+                except BackendError:
+                    failed.append(package)
+        return failed
+
+    def publish(self, distribution, prefix=None):
+        # aptly API escaping for prefix: '_' -> '__', '/' -> '_', '.' -> ':.'
+        prefix = ':.' if not prefix or prefix == '.' else prefix.replace('_', '__').replace('/', '_')
+        try:
+            self._call('PUT', '/publish/{0}/{1}'.format(urllib.quote(prefix, safe=':'),
+                                                        self._quote(distribution)), {})
+        except BackendError:
+            return False
+        return True
+
+    def db_cleanup(self):
+        self._call('POST', '/db/cleanup')
+
+
+def aptly_root(root=None):
+    """
+    Get aptly root dir
+    :param root: Root dir from config, if set
+    :return: Path to aptly root dir
+    """
+    if root:
+        return os.path.expanduser(root)
+    for conf_path in (os.path.expanduser('~/.aptly.conf'), '/etc/aptly.conf'):
+        try:
+            with open(conf_path) as f:
+                return os.path.expanduser(json.load(f)['rootDir'])
+        except (IOError, OSError, ValueError, KeyError):
+            continue
+    return os.path.expanduser('~/.aptly')
+
+
+def db_marker(root):
+    """
+    Get change marker of aptly DB: newest mtime of its files
+    :param root: aptly root dir
+    :return: float, None if DB is not accessible
+    """
+    db_dir = os.path.join(root, 'db')
+    try:
+        return max([os.stat(db_dir).st_mtime] +
+                   [os.stat(os.path.join(db_dir, name)).st_mtime for name in os.listdir(db_dir)])
+    except OSError:
+        return None
+
+
+def make_backend(conf, message=None, jobs=1, metrics=None):
+    """
+    Create backend by config. Falls back to CLI if API is not reachable
+    :param conf: config.Config
+    :param message: Callable for reporting fallback
+    :param jobs: Number of threads that will use backend
+    :param metrics: metrics.Metrics to count aptly calls in
+    :return: Backend
+    """
+    if conf.get_aptly_backend() == 'api':
+        backend = ApiBackend(conf.get_aptly_url(), pool_size=max(jobs, 1), metrics=metrics)
+        try:
+            backend.ping()
+            return backend
+        except (BackendError, httplib.HTTPException, socket.error, ValueError) as e:
+            if message:
+                message("aptly API at {0} is not available ({1}), falling back to cli".format(
+                    conf.get_aptly_url(), e))
+    return CliBackend(metrics)
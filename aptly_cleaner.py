@@ -1,48 +1,96 @@
 import argparse
-import os
-import glob
-import subprocess
-import math
+import threading
 from time import time, strftime
+import aptly_backend
 import config
+import deleter
+import fs_index
+import metrics
+import plan
+import repo_snapshot
+import repo_store
+import retention
+import scheduler
+import sharding
 
 
 class AptCleaner(object):
-    def __init__(self, config_file, verbose, dry_run, only_repo, calc):
+    def __init__(self, config_file, verbose, dry_run, only_repo, calc, jobs=1, rebuild_cache=False, store=None,
+                 file_index=None, shard=None):
+        """
+        :param store: repo_store.RepoStore kept between runs, repos already in it are not queried
+        :param file_index: fs_index.FileIndex kept up to date by caller, search dirs are not scanned then
+        :param shard: sharding.Shard, only its packages are matched. Cache file is not used then
+        """
         self._verbose = bool(verbose)
+        self._print_lock = threading.Lock()
         self.conf = config.Config(config_file)
+        self._jobs = jobs
+        self._shard = shard
 
         self._calc = calc
         self._saved = 0.0
+        # Files counted in _saved, file of version removed from several repos is freed once
+        self._saved_files = set()
         self._dry_run = dry_run or calc
         self._not_only_repo = not only_repo
 
         self._tmp_suffix = "_tmp"
 
-        self._cache = {}
+        self.store = store if store is not None else repo_store.RepoStore()
+        self._scan_fs = file_index is None
+        self.fs_index = file_index if file_index is not None else fs_index.FileIndex()
+        # Repos with priority higher than the one, as store bitmask
+        # { priority: repos_bitmask }
+        self._higher_repos = {}
+        self._repo_priority = {}
+        self._priority_status = {}
+        self._repo_status = {}
+        self._cleaned_repos = []
+        # Repos changed in store by this run
+        self.changed_repos = set()
+        # Repos packages were removed from in aptly, or would be on dry run. Only those are published
+        self._modified_repos = set()
+        # Operations skipped as nothing changed for them
+        self._skipped = []
+        # Files of matched packages that are removed by this run, or kept as their removal from repo failed.
+        # Those are not orphans for file_cleaner.FileFinder run after this one
+        self.handled_files = set()
+        # Files matched for removal from FS, version is not removed from other repos for the same file
+        self._claimed_files = set()
+        self._removed = 0
+        self._failed = []
+        # Plan lines failed to be removed by this apply
+        self._failed_lines = []
         self._init()
+        self.metrics = metrics.Metrics('aptly_cleaner')
+        self.backend = aptly_backend.make_backend(self.conf, lambda text: self._verbose_message(text, True), jobs,
+                                                  self.metrics)
+        # Shard keeps only part of each repo, which must not get to cache file
+        self.snapshot = repo_snapshot.open_snapshot(self.conf, rebuild_cache) if shard is None else None
+        self.deleter = deleter.Deleter(self.conf.get_delete_jobs(), self.conf.get_delete_rate_files(),
+                                       self.conf.get_delete_rate_mb(), self.metrics)
 
         self._check_time = time()
 
     def _init(self):
-        # {
-        #     repo_name: {
-        #         package_name: (arch, versions[])
-        #     }
-        # }
-        for _, status in self.conf.get_statuses():
+        for priority, status in self.conf.get_statuses():
+            self._priority_status[priority] = status
             for repo in self.conf.get_repos_by_status(status):
-                self._cache[repo] = {}
+                self.store.register(repo)
+                self._repo_priority[repo] = priority
+                self._repo_status[repo] = status
+
+        for priority in self._priority_status:
+            self._higher_repos[priority] = self.store.mask(repo for repo, repo_priority
+                                                           in self._repo_priority.iteritems()
+                                                           if repo_priority > priority)
 
         if self._dry_run:
             self._verbose_message("dry-run is active, will not delete anything", True)
 
     def outdated(self, package_time, repo_status):
-        return math.floor((self._check_time - package_time)/60/60/24) > self.conf.get_param_by_status(repo_status,
-                                                                                                      'days_to_live')
-
-    def _less_than_max(self, cnt, repo_status):
-        return cnt <= self.conf.get_param_by_status(repo_status, 'max_packages')
+        return retention.age_days(self._check_time, package_time) > self.conf.policy(repo_status).days_to_live
 
     def _version_from_name(self, name):
         # TODO: Replace with regexp maybe?
@@ -67,32 +115,27 @@ class AptCleaner(object):
 
         if not self.outdated(modif_time, from_status):
             return False
+        return not self._held_by_higher(self.conf.policy(from_status).priority, from_repo, package, version)
 
-        stats_list = self.conf.get_statuses()
-        curr_priority = self.conf.get_param_by_status(from_status, 'priority')
-
-        for priority, status in stats_list:
-            if curr_priority >= priority:  # Do not match current status
-                break
-
-            for repo in self.conf.get_repos_by_status(status):
-                if repo == from_repo and curr_priority == priority:
-                    continue
-
-                if package not in self._cache[repo]:
-                    continue
-
-                if version in self._cache[repo][package][1]:
-                    self._verbose_message("[%s] %s %s (%s) %s %s %s %s" % (self.not_matches_rules.__name__, "package",
-                                          package, version, "from", from_repo, "matched in", repo))
-                    return False
-        return True
-
-    def _remove_file_from_fs(self, package):
+    def _held_by_higher(self, curr_priority, from_repo, package, version):
         """
-        Remove files from FS by name(abs path)
+        Return bool whether package version is in repo of status with higher priority
+        """
+        holders = self.store.holders(package, version) & self._higher_repos[curr_priority]
+        if holders:
+            priority = max(self._repo_priority[repo] for repo in self.store.repos(holders))
+            self._verbose_message("[%s] %s %s (%s) %s %s %s %s" % (self.not_matches_rules.__name__, "package",
+                                  package, version, "from", from_repo, "matched in status",
+                                  self._priority_status[priority]))
+            return True
+        return False
+
+    def _remove_file_from_fs(self, package, size):
+        """
+        Queue file for removal from FS by name(abs path)
         :param package: Path to package that should be deleted. Must be absolute(in terms of this class)
-        :return: None, pass on error
+        :param size: File size
+        :return: None, errors are reported by _report_fs_failures
         """
         if self._verbose:
             self._verbose_message("[%s] %s %s" % (self._remove_file_from_fs.__name__, "removed from fs", package))
@@ -100,157 +143,341 @@ class AptCleaner(object):
         if self._dry_run:
             return
 
-        try:
-            os.remove(package)
-        except OSError:
-            self._verbose_message("[%s] %s %s" % (self._remove_file_from_fs.__name__,
-                                                  "failed to remove from fs:", package), True)
+        self.deleter.submit(package, size)
+
+    def _report_fs_failures(self):
+        failed = self.deleter.close()
+        for package, error in failed:
+            self._verbose_message("[%s] %s %s: %s" % (self._remove_file_from_fs.__name__,
+                                                      "failed to remove from fs", package, error), True)
+        if failed:
+            self._verbose_message("[{0}] {1}".format('do_all', 'files failed to remove from fs: %d' % len(failed)),
+                                  True)
 
     def _remove_package_from_repo(self, repo, package_name, package_version):
+        """
+        Remove package version from in-memory caches. Removal from aptly is done by _flush_removals
+        """
         if self._verbose:
             self._verbose_message("[%s] %s %s, %s (%s)" % (self._remove_package_from_repo.__name__,
                                                            "repo remove", repo, package_name, package_version))
-        package = "{0} (= {1})".format(package_name, package_version)
         # self._verbose_message("got version of package %s: %s" % (package_name, package_version))
-        self._cache[repo][package_name][1].remove(package_version)
-        if not self._dry_run:
-            subprocess.call(['aptly', 'repo', 'remove', repo, "'{0}'".format(package)])
+        if self.snapshot:
+            self.snapshot.modified(repo, not self._dry_run, self.store)
+        self.store.remove(repo, package_name, package_version)
+        self.changed_repos.add(repo)
 
-    def remove_package(self, package_name, package_file, repo):
-        package_version = self._version_from_name(package_file)
-        self._remove_package_from_repo(repo, package_name, package_version)
-        if self._not_only_repo:
-            self._remove_file_from_fs(package_file)
+    def _flush_removals(self, batch, checkpoint=None):
+        """
+        Remove batch of packages from one repo, then their files from FS
+        :param batch: List of tuples (plan_line_number, entry)
+        :param checkpoint: plan.Checkpoint to save progress to
+        :return: None
+        """
+        repo = batch[0][1]['repo']
+        with self.metrics.phase('removal', repo=repo):
+            failed = set()
+            if not self._dry_run:
+                failed = set(self.backend.remove(repo, [(entry['package'], entry['version']) for _, entry in batch]))
+
+            for number, entry in batch:
+                if (entry['package'], entry['version']) in failed:
+                    self.handled_files.update(package_file for package_file, _ in entry['files'])
+                    self._failed.append((repo, entry['package'], entry['version']))
+                    self._failed_lines.append(number)
+                    self.metrics.count('packages_failed')
+                    self._verbose_message("[%s] %s %s, %s (%s)" % (self._flush_removals.__name__,
+                                                                   "failed to remove from repo", repo,
+                                                                   entry['package'], entry['version']), True)
+                    continue
+                self._removed += 1
+                for package_file, size in entry['files']:
+                    if package_file not in self._saved_files:
+                        self._saved_files.add(package_file)
+                        self._saved += size / 1024.0 / 1024
+                self._modified_repos.add(repo)
+                if self._not_only_repo:
+                    self.handled_files.update(package_file for package_file, _ in entry['files'])
+                if self._dry_run:
+                    continue
+                self.metrics.count('packages_removed')
+                if self._not_only_repo:
+                    for package_file, size in entry['files']:
+                        self._remove_file_from_fs(package_file, size)
+
+        if checkpoint and not self._dry_run:
+            # Files of batch must be gone before it is skipped on resume
+            self.deleter.wait()
+            checkpoint.save(batch[-1][0], self._failed_lines)
 
-    def get_packages_in_dir(self, search_dir, package_format, versions, deep_scan=True):
+    def _execute(self, entries, checkpoint=None):
+        """
+        Remove packages in batches, each batch is from one repo
+        :param entries: Iterable of tuples (plan_line_number, entry)
+        :param checkpoint: plan.Checkpoint to save progress to
+        :return: None
+        """
+        batch_size = self.conf.get_remove_batch_size()
+        batch = []
+        for number, entry in entries:
+            if batch and (batch[0][1]['repo'] != entry['repo'] or len(batch) >= batch_size):
+                self._flush_removals(batch, checkpoint)
+                batch = []
+            batch.append((number, entry))
+        if batch:
+            self._flush_removals(batch, checkpoint)
+
+    def scan_search_dirs(self):
         """
-        Get files on FS in dir, with package_name
-        :param search_dir: Directory to 'scan'
-        :param package_format: Name of package to search for. Should contain placeholder for version
+        Build index of packages in all search dirs, walking each of them once
+        :return: None
+        """
+        accept = None
+        if self._shard:
+            # Files of packages from other shards are not stat'ed
+            accept = lambda key: self._shard.contains(key[0])
+        for search_dir in self.conf.get_glob_search_dirs():
+            with self.metrics.phase('fs_scan'):
+                found = self.fs_index.scan(search_dir, accept=accept)
+            self.metrics.count('files_stated', found)
+            self._verbose_message("found %d packages in %s" % (found, search_dir))
+
+    def get_packages_in_dir(self, package, arch, versions):
+        """
+        Get files of package versions from search dirs index
+        :param package: Name of package to search for
+        :param arch: Package architectures, comma separated
         :param versions: List of versions in order
-        :param deep_scan: If false - search only in dir/, else in dir/*/ also
-        :return: Generator, items as tuple (file_path, last_edit_time)
+        :return: Generator, items as tuple (version, [(file_path, last_edit_time, size)]).
+        Versions that have no files are skipped
         """
-
+        archs = arch.split(',')
         for version in versions:
-            try:
-                pckg_file = os.path.join(search_dir, package_format).format(version) + ".deb"
-                yield pckg_file, os.stat(pckg_file).st_mtime
-            except OSError:
-                pass
-            if deep_scan:
-                for pckg_file in glob.iglob(os.path.join(search_dir, '*', package_format).format(version) + ".deb"):
-                    yield (pckg_file, os.stat(pckg_file).st_mtime)
+            files = []
+            for package_arch in archs:
+                files.extend(self.fs_index.get(package, version, package_arch))
+            if files:
+                yield version, files
 
     def generate_package_cache(self, repo):
-        if self._cache[repo]:
+        with self.metrics.phase('cache', repo=repo):
+            self._generate_package_cache(repo)
+
+    def _generate_package_cache(self, repo):
+        if self.store.has_repo(repo):
             self._verbose_message("cache is already generated for repo %s" % repo)
             return
 
-        self._verbose_message("generating package cache for repo %s" % repo)
-        # Using 'Name' to search for all valid packages. As per https://www.aptly.info/doc/feature/query/
-        repo_lines = str(subprocess.check_output(
-            "aptly repo search " + repo + " 'Name' | sort -V", shell=True))
+        if self.snapshot:
+            packages = self.snapshot.get(repo)
+            if packages is not None:
+                self._verbose_message("loaded package cache for repo %s from cache file" % repo)
+                self.store.set_repo(repo, packages)
+                return
 
-        repo_lines = repo_lines.splitlines()
-        if len(repo_lines) < 1:
-            raise ValueError('invalid response: {0}'.format(repo_lines))
-        # Set default name
-        packg = repo_lines[0].split("_")[0]
-        versions = []
-        arch = repo_lines[0].split("_")[2]
-        for line in repo_lines:
-            raw_pack = line.split("_")
-
-            if raw_pack[0] != packg:
-                self._cache[repo][packg] = (arch, versions)
-
-                packg, arch = raw_pack[0], raw_pack[2]
-                versions = []
-
-            versions.append(raw_pack[1])
-        self._cache[repo][packg] = (arch, versions)
+        self._verbose_message("generating package cache for repo %s" % repo)
+        packages = aptly_backend.read_packages(self.backend.search(repo))
+        if not packages:
+            raise ValueError('invalid response: no packages in repo {0}'.format(repo))
+        if self._shard:
+            packages = dict((package, info) for package, info in packages.iteritems()
+                            if self._shard.contains(package))
+        self.store.set_repo(repo, packages)
+        if self.snapshot:
+            self.snapshot.put(repo)
 
     def walk_packages_in_repo(self, repo):
         """
         Get all number of packages in repo
         :param repo: Repo to check
-        :return: dict { package_name: count }, None if only_cache=True
+        :return: Generator, items as tuple (package_name, arch, count, versions[])
         """
         self.generate_package_cache(repo)
-        for package, info in self._cache[repo].iteritems():
-            arch = info[0]
-            versions = info[1]
+        for package, arch, versions in self.store.packages(repo):
             yield package, arch, len(versions), versions
 
+    @staticmethod
+    def _publish_target(distr, repo):
+        """
+        :return: Tuple (distribution, prefix) repo is published to
+        """
+        distribution, prefix = repo, None
+        if distr:
+            if repo.startswith(distr + '-'):
+                distribution, prefix = distr, repo
+            else:
+                distribution = "{0}-{1}".format(distr, repo)
+        return distribution, prefix
+
+    @staticmethod
+    def _publish_operation(distribution, prefix):
+        """
+        :return: Name of publish operation, as timed in snapshot
+        """
+        return 'publish {0}'.format(distribution + (' ' + prefix if prefix else ''))
+
     # Not yet polished so good. May(and probably will) fail miserably.
     def publish(self, distr, repo):
-        if distr:
-            repo = ("{0}-{1}" if not repo.startswith(distr + '-') else "{0} {1}").format(distr, repo)
+        distribution, prefix = self._publish_target(distr, repo)
 
-        self._verbose_message("[%s] %s %s" % (self.publish.__name__, "publishing repo", repo))
+        self._verbose_message("[%s] %s %s %s" % (self.publish.__name__, "publishing repo", distribution,
+                                                 prefix or ''))
         if self._dry_run:
-            return
+            return True
 
-        subprocess.call(['aptly', 'publish', 'update', repo])
+        start = time()
+        with self.metrics.phase('publish', repo=repo):
+            published = self.backend.publish(distribution, prefix)
+        if not published:
+            self._verbose_message("[%s] %s %s" % (self.publish.__name__, "failed to publish", repo), True)
+        elif self.snapshot:
+            self.snapshot.set_timing(self._publish_operation(distribution, prefix), time() - start)
+        return published
 
     def db_cleanup(self):
         if self._verbose:
             self._verbose_message("[%s] %s" % (self.db_cleanup.__name__, "db cleanup"))
 
         if self._dry_run:
-            return
+            return True
+        start = time()
         try:
-            subprocess.check_output(['aptly', 'db', 'cleanup', '-verbose'])
-        except:
+            with self.metrics.phase('db_cleanup'):
+                self.backend.db_cleanup()
+        except aptly_backend.BackendError:
             self._verbose_message("[%s] %s" % (self.db_cleanup.__name__, "failed to cleanup"))
+            return False
+        if self.snapshot:
+            self.snapshot.set_timing('db_cleanup', time() - start)
+        return True
 
-    def do_all_clean(self):
+    def _skip(self, operation):
+        """
+        Account operation that was not done, as nothing changed for it
+        :param operation: Operation name, as timed in snapshot
+        :return: None
+        """
+        self._verbose_message("[%s] %s %s" % ('do_all', "nothing changed, skipping", operation))
+        self._skipped.append(operation)
+        self.metrics.count('operations_skipped', label=operation.split(' ')[0])
 
+    def _report_skipped(self):
+        if not self._skipped:
+            return
+        timings = [self.snapshot.timing(operation) if self.snapshot else None for operation in self._skipped]
+        saved = sum(seconds for seconds in timings if seconds is not None)
+        unknown = sum(1 for seconds in timings if seconds is None)
+        self.metrics.count('seconds_saved', saved)
+        self._verbose_message("[{0}] {1}".format('do_all', 'skipped %d publishes/cleanups, saved %.3f seconds%s' % (
+            len(self._skipped), saved, ' (%d not timed yet)' % unknown if unknown else '')), True)
+
+    def iter_removals(self):
+        """
+        Generate caches and match all packages against rules.
+        In-memory caches are updated as if matched packages were removed
+        :return: Generator of plan entries, dicts with keys repo, status, package, version, arch,
+        files ([file_path, size] pairs), size and reason
+        """
         # gen cache first, than do a cleanup
+        repos = []
         for _, status in self.conf.get_statuses():
             # get repos from status
             for repo in self.conf.get_repos_by_status(status):
-                self.generate_package_cache(repo)
+                if repo not in repos:
+                    repos.append(repo)
+        scheduler.run_jobs(self.generate_package_cache, repos, self._jobs)
+        if self._scan_fs:
+            self.scan_search_dirs()
 
         # get priority and statuses
         for _, status in self.conf.get_statuses():
+            policy = self.conf.policy(status)
             # Do not do cleanup if status is marked as 'reference_only'
             # reference_only statuses are used to do only rule matching
-            if self.conf.get_param_by_status(status, 'reference_only'):
+            if policy.reference_only:
                 self._verbose_message("{0} status is reference only, gen cache & skipping cleanup".format(status))
-                # continue
+                continue
 
+            max_packages = policy.max_packages
+            days_to_live = policy.days_to_live
+            priority = policy.priority
             # get repos from status
-            for repo in self.conf.get_repos_by_status(status):
-                # self.__tmp_copy_repo(repo)
-                if self.conf.get_param_by_status(status, 'reference_only'):
-                    continue
-                # get packages in repo
-                for package, arch, count, versions in self.walk_packages_in_repo(repo):
-                    # if len(versions) > max_count for repo - go for FS search
-                    if self._less_than_max(count, status):
-                        continue
-
-                    package_format = "_".join([package, "{0}", arch])
-                    for search_dir in self.conf.get_glob_search_dirs():
-                        # search only for versions that are not greater than last possible
-                        for pckg_file, modif_time in self.get_packages_in_dir(search_dir,
-                                                                              package_format,
-                                                                              versions[:-self.conf.get_max_packages(
-                                                                                  status)]):
-                            # print "[{0}][{1}]".format(status, repo), pckg_file, self.outdated(modif_time, status)
-                            if self.not_matches_rules(status, repo, package,
-                                                      self._version_from_name(pckg_file), modif_time):
-                                if self._calc:
-                                    self._saved += os.stat(pckg_file).st_size / 1024 / 1024
-                                self.remove_package(package,
-                                                    pckg_file,
-                                                    repo)
-                self.publish(self.conf.get_param_by_status(status, 'distribution'), repo)
+            for repo in policy.repo_list:
+                with self.metrics.phase('matching', repo=repo):
+                    # Versions with files of packages that have more than max_packages versions,
+                    # retention rules are evaluated for all of them at once
+                    candidates, mtimes = [], []
+                    for package, arch, count, versions in self.walk_packages_in_repo(repo):
+                        if count <= max_packages:
+                            continue
+
+                        # Newest max_packages versions are always kept, so their files are not looked up
+                        older = versions[:-max_packages]
+                        for version, files in self.get_packages_in_dir(package, arch, older):
+                            files = [package_file for package_file in files
+                                     if package_file[0] not in self._claimed_files]
+                            if not files:
+                                # Files are already removed for other repo, so version is kept in this one
+                                continue
+                            candidates.append((package, arch, version, files))
+                            # Version is kept while any of its files is not outdated
+                            mtimes.append(max(modif_time for _, modif_time, _ in files))
+
+                    for index in retention.removable(self._check_time, mtimes, days_to_live):
+                        package, arch, version, files = candidates[index]
+                        if self._held_by_higher(priority, repo, package, version):
+                            continue
+                        self._remove_package_from_repo(repo, package, version)
+                        if self._not_only_repo:
+                            self._claimed_files.update(pckg_file for pckg_file, _, _ in files)
+                        yield {
+                            'repo': repo,
+                            'status': status,
+                            'package': package,
+                            'version': version,
+                            'arch': arch,
+                            'files': [[pckg_file, size] for pckg_file, _, size in files],
+                            'size': sum(size for _, _, size in files),
+                            'reason': 'not in newest {0} versions, {1} days old'.format(
+                                max_packages, int(retention.age_days(self._check_time, mtimes[index]))),
+                        }
+                self._cleaned_repos.append(repo)
                 # self.__tmp_drop_repo(repo)
                 self._verbose_message("-" * 20)
-        self.db_cleanup()
+
+    def _finish(self, repos):
+        """
+        Publish cleaned repos, cleanup DB and report results
+        :param repos: List of repos to publish
+        :return: True if all repos are published and DB is cleaned up
+        """
+        # Only changed repos are published, once per distribution
+        to_publish, targets, unchanged = [], set(), []
+        for repo in repos:
+            distr = self.conf.policy(self._repo_status[repo]).distribution
+            target = self._publish_target(distr, repo)
+            if repo not in self._modified_repos:
+                unchanged.append(target)
+            elif target in targets:
+                self._skip(self._publish_operation(*target))
+            else:
+                targets.add(target)
+                to_publish.append((distr, repo))
+        for target in unchanged:
+            if target not in targets:
+                targets.add(target)
+                self._skip(self._publish_operation(*target))
+
+        # Repos are published after all of them are cleaned, as publishing does not affect rule matching
+        finished = all(scheduler.run_jobs(lambda args: self.publish(*args), to_publish, self._jobs))
+        # Unreferenced packages are left in DB only if some were removed from repos
+        if self._modified_repos:
+            finished = self.db_cleanup() and finished
+        else:
+            self._skip('db_cleanup')
+        self._report_fs_failures()
+        if self.snapshot:
+            self.snapshot.save(self.store)
 
         size = "MBs"
         if self._saved > 1024.0:
@@ -258,12 +485,111 @@ class AptCleaner(object):
             size = "GBs"
 
         self._verbose_message("[{0}] {1}".format('do_all', 'overall spoiled: %.3f %s' % (self._saved, size)), True)
+        self._verbose_message("[{0}] {1}".format('do_all', 'packages removed: %d, failed: %d' % (self._removed,
+                                                                                             len(self._failed))), True)
+        self._report_skipped()
+        return finished
+
+    def do_all_clean(self):
+        """
+        :return: Tuple (removed_count, [(repo, package_name, version)] failed to remove)
+        """
+        self._execute(enumerate(self.iter_removals(), 1))
+        self._finish(self._cleaned_repos)
+        return self._removed, self._failed
+
+    def write_plan(self, plan_path):
+        """
+        Match all packages against rules and write removals to plan, without removing anything
+        :param plan_path: Path to plan file
+        :return: None
+        """
+        planned, size = 0, 0
+        with plan.PlanWriter(plan_path) as writer:
+            for entry in self.iter_removals():
+                if self._shard:
+                    entry['shard'] = str(self._shard)
+                writer.write(entry)
+                planned += 1
+                size += entry['size']
+        if self.snapshot:
+            self.snapshot.save(self.store)
+        self._verbose_message("[{0}] {1}".format('write_plan', 'planned %d removals, %.3f MBs to %s' % (
+            planned, size / 1024.0 / 1024, plan_path)), True)
+
+    def merge_plans(self, plan_path, shard_plans):
+        """
+        Merge plans written by shards into one plan, to be applied by --apply
+        :param plan_path: Path to merged plan
+        :param shard_plans: Paths to plans of shards
+        :return: None
+        """
+        repos = [repo for _, status in self.conf.get_statuses() for repo in self.conf.get_repos_by_status(status)]
+        # Plans that can not be merged are rejected before previous plan and its progress are replaced
+        plan.check_shards(shard_plans)
+        with plan.PlanWriter(plan_path) as writer:
+            merged, shards = plan.merge_plans(shard_plans, repos, writer)
+
+        if shards:
+            count = int(shards[0].split('/')[1])
+            missing = sorted(set('{0}/{1}'.format(index, count) for index in range(1, count + 1)) - set(shards))
+            if missing:
+                # Shard that found nothing to remove writes empty plan, so it can not be told from missing one
+                self._verbose_message("[{0}] {1}".format('merge_plans', 'no removals from shards: ' +
+                                                         ', '.join(missing)), True)
+        self._verbose_message("[{0}] {1}".format('merge_plans', 'merged %d removals from %d plans to %s' % (
+            merged, len(shard_plans), plan_path)), True)
+
+    def apply_plan(self, plan_path):
+        """
+        Remove packages listed in plan, without matching them against rules.
+        Progress is saved after each batch, so interrupted apply continues where it stopped
+        :param plan_path: Path to plan file
+        :return: None
+        """
+        checkpoint = plan.Checkpoint(plan_path)
+        done, retry, published = checkpoint.load()
+        if published:
+            self._verbose_message("[{0}] {1}".format('apply_plan', 'plan is already applied and published'), True)
+            return
+        if done:
+            self._verbose_message("[{0}] {1}".format('apply_plan', 'resuming after line %d, retrying %d failed lines'
+                                                     % (done, len(retry))), True)
+
+        repos = []
+        # Number of last line of plan
+        lines = [0]
+
+        def entries():
+            for number, entry in plan.read_plan(plan_path):
+                lines[0] = number
+                repo = entry['repo']
+                if repo not in repos:
+                    repos.append(repo)
+                if number <= done and number not in retry:
+                    # Removed by interrupted apply, which might have not published repo
+                    self._modified_repos.add(repo)
+                    continue
+                if self.snapshot:
+                    self.snapshot.modified(repo, not self._dry_run, self.store)
+                if self._verbose:
+                    self._verbose_message("[%s] %s %s, %s (%s): %s" % ('apply_plan', "repo remove", repo,
+                                                                       entry['package'], entry['version'],
+                                                                       entry['reason']))
+                yield number, entry
+
+        self._execute(entries(), checkpoint)
+        # Failed lines are retried by next apply, so plan is not finished yet
+        if self._finish(repos) and not self._dry_run and not self._failed_lines:
+            # Nothing is left to remove or publish, so applying plan again does nothing
+            checkpoint.save(lines[0], published=True)
 
     def _verbose_message(self, text, force=False):
         if not self._verbose and not force:
             return
 
-        print strftime("[%Y/%m/%d %H:%M:%S]"), text
+        with self._print_lock:
+            print strftime("[%Y/%m/%d %H:%M:%S]"), text
 
 if __name__ == '__main__':
     # TODO: Also remove deps for removed packages?
@@ -274,11 +600,59 @@ if __name__ == '__main__':
     parser.add_argument('-r', '--only-from-repo', action='store_true', help="Remove packages only from repo, not FS")
     parser.add_argument('--calc', action='store_true', default=False, help="This option will calculate saved size" +
                         "Forces --dry-run, so will not actually delete anything")
+    parser.add_argument('--remove-orphans', action='store_true', default=False,
+                        help='Then also remove packages in search dirs that are not in any repo, as file_cleaner.py -r '
+                             'does, reusing repo caches and search dirs index of this run')
+    parser.add_argument('--plan', metavar='PLAN', help="Write packages to remove to PLAN file, don't remove them")
+    parser.add_argument('--shard', metavar='I/N', type=sharding.Shard.parse,
+                        help="Match only packages of shard I of N, split by package name. Requires --plan")
+    parser.add_argument('--merge', metavar='SHARD_PLAN', nargs='+',
+                        help="Merge plans written by shards to --plan file, instead of matching packages")
+    parser.add_argument('--apply', metavar='PLAN', help="Remove packages listed in PLAN file, written by --plan")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of repos to query and publish concurrently')
+    parser.add_argument('--rebuild-cache', action='store_true', default=False,
+                        help='Query all repos from aptly, ignoring cache file')
+    parser.add_argument('--metrics-json', metavar='PATH', help='Write timings and counters of run to PATH as JSON')
+    parser.add_argument('--metrics-textfile', metavar='PATH',
+                        help='Write timings and counters of run to PATH in node_exporter textfile format')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Profile run, write PATH.pstats, PATH.collapsed stacks for flamegraphs and PATH.json')
+    parser.add_argument('--profile-mode', choices=('cprofile', 'sample'), default='cprofile',
+                        help="'cprofile' profiles every call, 'sample' only samples stacks, with low overhead")
+    parser.add_argument('--profile-interval', type=float, default=0.01, metavar='SECONDS',
+                        help='Seconds between stack samples of --profile')
+    parser.add_argument('--serve', action='store_true', default=False,
+                        help='Keep caches in memory and clean on schedule or when asked through --socket')
+    parser.add_argument('--socket', metavar='PATH', help='Control socket of --serve')
+    parser.add_argument('--interval', type=int, default=0,
+                        help='Seconds between cleanups of --serve, 0 to clean only when asked')
+    parser.add_argument('--control', metavar='COMMAND', choices=('clean', 'dry-run', 'status', 'stop'),
+                        help='Send COMMAND (clean, dry-run, status or stop) to --serve listening on --socket')
     parser.add_argument('--force-invalid-user', action='store_true', default=False,
                         help='Use invalid user(not that specified in config) for running this script')
 
     args = parser.parse_args()
-    cleaner = AptCleaner(args.config, args.verbose, args.dry_run, args.only_from_repo, args.calc)
+    if args.plan and args.apply:
+        parser.error('--plan and --apply can not be used together')
+    if (args.shard or args.merge) and not args.plan:
+        parser.error('--shard and --merge require --plan')
+    if args.shard and args.merge:
+        parser.error('--shard and --merge can not be used together')
+    if args.remove_orphans and (args.plan or args.apply or args.serve):
+        parser.error('--remove-orphans can not be used with --plan, --apply or --serve')
+    if (args.serve or args.control) and not args.socket:
+        parser.error('--serve and --control require --socket')
+    if args.control:
+        import serve
+        reply = serve.send_command(args.socket, args.control)
+        print reply
+        raise SystemExit(0 if reply.startswith('ok') else 1)
+    if args.profile:
+        import profiler
+        profiler.start(args.profile, args.profile_mode, args.profile_interval)
+    cleaner = AptCleaner(args.config, args.verbose, args.dry_run or bool(args.plan), args.only_from_repo, args.calc,
+                         args.jobs, args.rebuild_cache, shard=args.shard)
 
     import getpass
     # Hardcoded as not needed to be configured as much
@@ -286,4 +660,23 @@ if __name__ == '__main__':
         raise EnvironmentError("Invalid user! To minimise damage current user cannot run this script.\n"
                                "Use --force-invalid-user if you want to force run with current user")
 
-    cleaner.do_all_clean()
+    if args.serve:
+        import serve
+        serve.Server(args.config, args.socket, args.interval, args.verbose, args.dry_run, args.only_from_repo,
+                     args.jobs, args.metrics_json, args.metrics_textfile).serve_forever()
+    elif args.merge:
+        cleaner.merge_plans(args.plan, args.merge)
+    elif args.plan:
+        cleaner.write_plan(args.plan)
+    elif args.apply:
+        cleaner.apply_plan(args.apply)
+    else:
+        cleaner.do_all_clean()
+    if args.remove_orphans:
+        import file_cleaner
+        file_cleaner.FileFinder(args.config, args.dry_run or args.calc, True, args.verbose, args.jobs,
+                                store=cleaner.store, file_index=cleaner.fs_index, exclude=cleaner.handled_files,
+                                run_metrics=cleaner.metrics).do_all()
+    if not args.serve:
+        # Metrics of --serve are written after every cleanup
+        cleaner.metrics.write(args.metrics_json, args.metrics_textfile)
@@ -0,0 +1,579 @@
+"""
+Benchmark of aptly_cleaner.py and file_cleaner.py on synthetic package trees.
+
+Every phase is run in its own process against a freshly generated tree, with a fake
+`aptly` on PATH that replays generated `repo search` output and records all calls.
+Results are printed as JSON, so they can be saved and compared between versions.
+
+With --check-versions, version ordering is checked against known dpkg results instead,
+and its throughput is measured. With --check-api, API backend is checked against stub of aptly API.
+With --check-shards, plans of shards written by concurrent runs are merged and compared with unsharded plan.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+PHASES = ('aptly_cleaner', 'aptly_cleaner_calc', 'file_cleaner')
+
+# Results of `dpkg --compare-versions A op B`, as (A, op, B)
+VERSION_CASES = [
+    ('1.0', '<', '1.1'), ('1.0~rc1', '<', '1.0'), ('1.0', '<', '1.0-1'), ('1:0.1', '>', '2.0'),
+    ('0:1.0', '=', '1.0'), ('1.0-0', '=', '1.0'), ('1.0a', '>', '1.0'), ('1.0+b1', '>', '1.0'),
+    ('1.0~~', '<', '1.0~'), ('1.0~~a', '<', '1.0~'), ('1.0~', '<', '1.0'), ('1.0.0', '>', '1.0'),
+    ('2.0', '<', '10.0'), ('1.0-1', '<', '1.0-2'), ('1.0-1ubuntu1', '>', '1.0-1'), ('1.0-1~bpo1', '<', '1.0-1'),
+    ('1.2.3-4', '<', '1.2.3-10'), ('1.0a', '<', '1.0b'), ('1.0a', '<', '1.0.'), ('1.0.', '>', '1.0+'),
+    ('1.0-1', '=', '1.0-01'), ('2:1.0', '>', '1:9.9'), ('1.0~rc1-1', '<', '1.0-1'), ('7.6p2-4', '>', '7.6-0'),
+    ('1.0.3-3', '>', '1.0-1'), ('1.3', '>', '1.2.2-2'), ('0-pre', '=', '0-pre'), ('0-pre', '<', '0-pree'),
+    ('1.1.6r2-2', '>', '1.1.6r-1'), ('2.6b2-1', '>', '2.6b-2'), ('98.1p5-1', '<', '98.1-pre2-b6-2'),
+    ('0.4a6-2', '>', '0.4-1'), ('1:3.0.5-2', '<', '1:3.0.5.1'), ('10.3', '<', '1:0.4'),
+    ('1:1.25-4', '<', '1:1.25-8'), ('0:1.18.36', '=', '1.18.36'), ('1.18.36', '>', '1.18.35'),
+    ('9:1.18.36:5.4-20', '<', '10:0.5.1-22'), ('9:1.18.36:5.4-20', '<', '9:1.18.36:5.5-1'),
+    ('1.18.36-0.17.35-18', '>', '1.18.36-19'), ('1:1.2.13-3', '<', '1:1.2.13-3.1'), ('2.0.7pre1-4', '<', '2.0.7r-1'),
+    ('0:0-0-0', '>', '0-0'), ('0:0:0-0', '>', '0:0-0'), ('1.0-1+deb9u1', '>', '1.0-1'), ('1.0+dfsg-1', '>', '1.0-1'),
+    ('1.0+dfsg-1', '<', '1.0.1-1'), ('3.0~beta1', '<', '3.0~rc1'), ('50.0.2661.102-1', '>', '50.0.2661.94-1'),
+]
+
+FAKE_APTLY = r'''
+import json
+import os
+import sys
+
+root = os.environ['FAKE_APTLY_ROOT']
+args = sys.argv[1:]
+with open(os.path.join(root, 'calls.log'), 'a') as f:
+    f.write(json.dumps(args) + '\n')
+
+if args[:2] == ['repo', 'search']:
+    with open(os.path.join(root, 'repos', args[2])) as f:
+        sys.stdout.write(f.read())
+'''
+
+
+def generate_tree(workdir, packages, versions, subdirs, repos, search_dirs=2):
+    """
+    Generate search dirs with packages, repos contents, config and fake aptly
+    :param workdir: Directory to generate everything in
+    :param packages: Number of packages
+    :param versions: Number of versions of each package in repos
+    :param subdirs: Number of subdirs in each search dir, 0 to put packages directly into search dir
+    :param repos: Number of repos
+    :param search_dirs: Number of search dirs
+    :return: Path to config
+    """
+    now = time.time()
+    dirs = [os.path.join(workdir, 'uploads%d' % i) for i in range(search_dirs)]
+    for directory in dirs:
+        os.makedirs(directory)
+        for sub in range(subdirs):
+            os.makedirs(os.path.join(directory, 'sub%d' % sub))
+
+    for p in range(packages):
+        # Two versions more than in repos, those are orphans for file_cleaner
+        for v in range(versions + 2):
+            directory = dirs[p % search_dirs]
+            if subdirs:
+                directory = os.path.join(directory, 'sub%d' % (v % subdirs))
+            path = os.path.join(directory, 'pkg%05d_1.0.%d_amd64.deb' % (p, v))
+            with open(path, 'w') as f:
+                f.write('x' * 512)
+            # Older versions are older by 5 days each
+            age = now - (versions - v) * 5 * 24 * 60 * 60
+            os.utime(path, (age, age))
+
+    os.makedirs(os.path.join(workdir, 'aptly', 'repos'))
+    repo_names = ['repo%d' % r for r in range(repos)]
+    for r, repo in enumerate(repo_names):
+        with open(os.path.join(workdir, 'aptly', 'repos', repo), 'w') as f:
+            for p in range(packages):
+                # Every third package is shared between all repos, for cross-priority matching
+                if p % repos == r or p % 3 == 0:
+                    for v in range(versions):
+                        f.write('pkg%05d_1.0.%d_amd64\n' % (p, v))
+
+    bin_dir = os.path.join(workdir, 'bin')
+    os.makedirs(bin_dir)
+    aptly = os.path.join(bin_dir, 'aptly')
+    with open(aptly, 'w') as f:
+        f.write('#!' + sys.executable + '\n' + FAKE_APTLY)
+    os.chmod(aptly, 0o755)
+
+    production = max(1, repos // 5)
+    config_path = os.path.join(workdir, 'config.conf')
+    with open(config_path, 'w') as f:
+        f.write("[repo_info]\n")
+        f.write("search_dirs = {0},\n".format(', '.join("'%s'" % d for d in dirs)))
+        f.write("[repos]\n")
+        f.write("    [[production]]\n    days_to_live = 30\n    max_packages = 10\n    priority = 100\n")
+        f.write("    distribution = ''\n    repo_list = {0},\n".format(', '.join(repo_names[:production])))
+        f.write("    [[testing]]\n    days_to_live = 10\n    max_packages = 5\n    priority = 10\n")
+        f.write("    distribution = ''\n    repo_list = {0},\n".format(', '.join(repo_names[production:])))
+    return config_path
+
+
+def _count_fs_calls(counters):
+    """
+    Wrap os functions that hit filesystem to count their calls
+    :param counters: dict to count calls in
+    :return: None
+    """
+    def wrap(module, name):
+        func = getattr(module, name)
+        counters.setdefault(name, 0)
+
+        def counted(*args, **kwargs):
+            counters[name] += 1
+            return func(*args, **kwargs)
+        setattr(module, name, counted)
+
+    for name in ('stat', 'lstat', 'listdir', 'remove', 'scandir'):
+        if hasattr(os, name):
+            wrap(os, name)
+    try:
+        import scandir
+        wrap(scandir, 'scandir')
+    except ImportError:
+        pass
+
+
+def _proc_io():
+    """
+    Get number of read and write syscalls done by this process
+    :return: dict, empty if not available
+    """
+    result = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, value = line.split(':')
+                if key in ('syscr', 'syscw'):
+                    result[key] = int(value)
+    except (IOError, OSError):
+        pass
+    return result
+
+
+def run_phase(phase, workdir, jobs):
+    """
+    Run phase in current process
+    :return: dict with measurements
+    """
+    fs_calls = {}
+    # Must be done before cleaners are imported, as they may bind os functions on import
+    _count_fs_calls(fs_calls)
+    import aptly_cleaner
+    import file_cleaner
+
+    config_path = os.path.join(workdir, 'config.conf')
+    calls_log = os.path.join(workdir, 'aptly', 'calls.log')
+    io_before = _proc_io()
+    start = time.time()
+
+    if phase == 'aptly_cleaner':
+        tool = aptly_cleaner.AptCleaner(config_path, False, False, False, False, jobs)
+        tool.do_all_clean()
+    elif phase == 'aptly_cleaner_calc':
+        tool = aptly_cleaner.AptCleaner(config_path, False, False, False, True, jobs)
+        tool.do_all_clean()
+    elif phase == 'file_cleaner':
+        tool = file_cleaner.FileFinder(config_path, False, True, False, jobs)
+        tool.do_all()
+    else:
+        raise ValueError('unknown phase {0}'.format(phase))
+
+    wall_time = time.time() - start
+    io_after = _proc_io()
+
+    aptly_calls = {}
+    if os.path.exists(calls_log):
+        with open(calls_log) as f:
+            for line in f:
+                command = ' '.join(json.loads(line)[:2])
+                aptly_calls[command] = aptly_calls.get(command, 0) + 1
+
+    return {
+        'phase': phase,
+        'wall_time': wall_time,
+        'aptly_calls': aptly_calls,
+        'fs_calls': fs_calls,
+        'syscalls': dict((key, io_after[key] - io_before.get(key, 0)) for key in io_after),
+        # Linux reports it in KB
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'metrics': tool.metrics.as_dict(),
+    }
+
+
+def run(args):
+    results = {
+        'params': {
+            'packages': args.packages,
+            'versions': args.versions,
+            'subdirs': args.subdirs,
+            'repos': args.repos,
+            'jobs': args.jobs,
+        },
+        'phases': [],
+    }
+    for phase in args.phases.split(','):
+        workdir = tempfile.mkdtemp(prefix='aptly_cleaner_bench_')
+        try:
+            generate_tree(workdir, args.packages, args.versions, args.subdirs, args.repos)
+            env = dict(os.environ)
+            env['PATH'] = os.path.join(workdir, 'bin') + os.pathsep + env.get('PATH', '')
+            env['FAKE_APTLY_ROOT'] = os.path.join(workdir, 'aptly')
+            result_path = os.path.join(workdir, 'result.json')
+            with open(os.devnull, 'w') as devnull:
+                subprocess.check_call([sys.executable, os.path.abspath(__file__), '--run-phase', phase,
+                                       '--workdir', workdir, '--jobs', str(args.jobs), '--result', result_path],
+                                      env=env, stdout=devnull)
+            with open(result_path) as f:
+                results['phases'].append(json.load(f))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def check_versions(count):
+    """
+    Check debversion against known dpkg results, check that sort keys order versions as
+    direct comparison does, and measure sorting throughput
+    :param count: Number of random versions to sort
+    :return: dict with results, mismatches are listed under 'failures'
+    """
+    import debversion
+
+    failures = []
+    for a, relation, b in VERSION_CASES:
+        result = debversion.compare(a, b)
+        key_result = cmp(debversion.version_key(a), debversion.version_key(b))
+        for name, value in (('compare', result), ('version_key', key_result)):
+            got = '<' if value < 0 else '=' if value == 0 else '>'
+            if got != relation:
+                failures.append('{0}: {1} {2} {3}, expected {4}'.format(name, a, got, b, relation))
+
+    rand = random.Random(0)
+    parts = ['0', '1', '2', '10', '.', '+', '~', 'a', 'rc', 'dfsg', 'b']
+    versions = []
+    for _ in range(count):
+        version = str(rand.randint(0, 20)) + ''.join(rand.choice(parts) for _ in range(rand.randint(0, 6)))
+        if rand.random() < 0.3:
+            version += '-' + str(rand.randint(0, 5)) + rand.choice(['', 'ubuntu1', '~bpo1', '+deb9u1'])
+        if rand.random() < 0.1:
+            version = '{0}:{1}'.format(rand.randint(1, 3), version)
+        versions.append(version)
+
+    for a, b in zip(versions[:2000], versions[1:2001]):
+        if cmp(debversion.version_key(a), debversion.version_key(b)) != cmp(debversion.compare(a, b), 0):
+            failures.append('version_key disagrees with compare: {0} {1}'.format(a, b))
+
+    debversion._keys.clear()
+    start = time.time()
+    debversion.sort_versions(list(versions))
+    cold = time.time() - start
+    start = time.time()
+    debversion.sort_versions(list(versions))
+    cached = time.time() - start
+    return {
+        'cases': len(VERSION_CASES),
+        'failures': failures,
+        'versions': count,
+        'sort_seconds': cold,
+        'sort_cached_seconds': cached,
+        'versions_per_second': count / cold if cold else None,
+        'versions_per_second_cached': count / cached if cached else None,
+    }
+
+
+def _stub_api(repos, requests):
+    """
+    Start stub of `aptly api serve` on random local port
+    :param repos: dict { repo: [package ref] }, changed by requests
+    :param requests: List to record requests to, as tuples (method, path, query)
+    :return: Tuple (server, url)
+    """
+    import BaseHTTPServer
+    import SocketServer
+    import threading
+    import urlparse
+
+    def matches(ref, query):
+        if query == 'Name':
+            return True
+        _, name, version, _ = ref.split(' ')
+        return '{0} (= {1})'.format(name, version) in query.split(' | ')
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        # Keep-alive, as used by ConnectionPool
+        protocol_version = 'HTTP/1.1'
+
+        def _reply(self, status, data):
+            body = json.dumps(data)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self, method):
+            url = urlparse.urlparse(self.path)
+            query = urlparse.parse_qs(url.query).get('q', [''])[0]
+            length = int(self.headers.getheader('content-length') or 0)
+            body = json.loads(self.rfile.read(length)) if length else None
+            requests.append((method, url.path, query))
+            parts = url.path.split('/')[2:]
+            if method == 'GET' and parts == ['version']:
+                return self._reply(200, {'Version': 'stub'})
+            if parts[:1] == ['repos'] and parts[2:] == ['packages'] and parts[1] in repos:
+                if method == 'GET':
+                    return self._reply(200, [ref for ref in repos[parts[1]] if matches(ref, query)])
+                if method == 'DELETE':
+                    missing = set(body['PackageRefs']) - set(repos[parts[1]])
+                    if missing:
+                        return self._reply(404, {'error': 'unknown refs'})
+                    repos[parts[1]] = [ref for ref in repos[parts[1]] if ref not in body['PackageRefs']]
+                    return self._reply(200, {})
+            if method == 'PUT' and parts[:1] == ['publish']:
+                return self._reply(200, {})
+            if method == 'POST' and parts == ['db', 'cleanup']:
+                return self._reply(200, {})
+            self._reply(404, {'error': 'not found'})
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_PUT(self):
+            self._handle('PUT')
+
+        def do_POST(self):
+            self._handle('POST')
+
+        def do_DELETE(self):
+            self._handle('DELETE')
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        # Connections are kept alive by pool, so each is served by its own thread
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:{0}/api'.format(server.server_address[1])
+
+
+def check_api():
+    """
+    Check API backend against stub of aptly API: search, removal with one lookup per batch,
+    publish and db cleanup
+    :return: dict with results, mismatches are listed under 'failures'
+    """
+    import aptly_backend
+
+    repos = {'repo1': ['P{0} pkg{1} 1.0.{2} hash{1}{2}{0}'.format(arch, p, v)
+                       for p in range(50) for v in range(3) for arch in ('amd64', 'i386')]}
+    requests = []
+    server, url = _stub_api(repos, requests)
+    failures = []
+    try:
+        backend = aptly_backend.ApiBackend(url)
+        if backend.ping().get('Version') != 'stub':
+            failures.append('ping failed')
+
+        found = sorted(backend.search('repo1'))
+        expected = sorted('pkg{0}_1.0.{1}_{2}'.format(p, v, arch)
+                          for p in range(50) for v in range(3) for arch in ('amd64', 'i386'))
+        if found != expected:
+            failures.append('search returned {0} packages, expected {1}'.format(len(found), len(expected)))
+        if vars(backend).get('_refs'):
+            failures.append('backend keeps package refs after search')
+
+        del requests[:]
+        batch = [('pkg{0}'.format(p), '1.0.0') for p in range(20)] + [('pkg0', '9.9'), ('missing', '1.0')]
+        failed = backend.remove('repo1', batch)
+        if sorted(failed) != [('missing', '1.0'), ('pkg0', '9.9')]:
+            failures.append('remove failed for {0}'.format(failed))
+        lookups = [request for request in requests if request[0] == 'GET']
+        if len(lookups) != 1:
+            failures.append('remove looked up refs with {0} requests, expected 1'.format(len(lookups)))
+        left = set(tuple(ref.split(' ')[1:3]) for ref in repos['repo1'])
+        if any(package in left for package in batch) or len(repos['repo1']) != 260:
+            failures.append('remove left {0} refs, expected 260'.format(len(repos['repo1'])))
+
+        if not backend.publish('wheezy', 'prefix/path'):
+            failures.append('publish failed')
+        if requests[-1][:2] != ('PUT', '/api/publish/prefix_path/wheezy'):
+            failures.append('publish requested {0}'.format(requests[-1][1]))
+        try:
+            backend.db_cleanup()
+        except aptly_backend.BackendError as e:
+            failures.append('db cleanup failed: {0}'.format(e))
+    finally:
+        backend.close()
+        server.shutdown()
+    return {
+        'requests': len(requests),
+        'failures': failures,
+    }
+
+
+def _entries(plan_path):
+    """
+    :return: Sorted entries of plan without their shard, as JSON strings
+    """
+    entries = []
+    with open(plan_path) as f:
+        for line in f:
+            entry = json.loads(line)
+            entry.pop('shard', None)
+            entries.append(json.dumps(entry, sort_keys=True))
+    return sorted(entries)
+
+
+def check_shards(count, args):
+    """
+    Write plans of count shards by concurrent runs, merge them and compare with plan of unsharded run.
+    Merge of plans of different number of shards must fail without touching previous plan
+    :param count: Number of shards
+    :return: dict with results, mismatches are listed under 'failures'
+    """
+    workdir = tempfile.mkdtemp(prefix='aptly_cleaner_shards_')
+    failures = []
+    try:
+        config_path = generate_tree(workdir, args.packages, args.versions, args.subdirs, args.repos)
+        env = dict(os.environ)
+        env['PATH'] = os.path.join(workdir, 'bin') + os.pathsep + env.get('PATH', '')
+        env['FAKE_APTLY_ROOT'] = os.path.join(workdir, 'aptly')
+        cleaner = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aptly_cleaner.py'),
+                   '-c', config_path, '--force-invalid-user']
+        plan_path = os.path.join(workdir, 'plan')
+        merged_path = os.path.join(workdir, 'merged')
+        shard_paths = [os.path.join(workdir, 'shard%d' % index) for index in range(1, count + 1)]
+
+        with open(os.devnull, 'w') as devnull:
+            start = time.time()
+            subprocess.check_call(cleaner + ['--plan', plan_path], env=env, stdout=devnull)
+            unsharded_time = time.time() - start
+
+            start = time.time()
+            processes = [subprocess.Popen(cleaner + ['--plan', path, '--shard', '%d/%d' % (index, count)],
+                                          env=env, stdout=devnull)
+                         for index, path in enumerate(shard_paths, 1)]
+            codes = [process.wait() for process in processes]
+            sharded_time = time.time() - start
+            if any(codes):
+                failures.append('shard runs exited with {0}'.format(codes))
+            subprocess.check_call(cleaner + ['--plan', merged_path, '--merge'] + shard_paths, env=env, stdout=devnull)
+
+            expected = _entries(plan_path)
+            merged = _entries(merged_path)
+            if merged != expected:
+                failures.append('merged plan has {0} entries, {1} differ from {2} of unsharded plan'.format(
+                    len(merged), len(set(merged) ^ set(expected)), len(expected)))
+
+            # Plan of shard 1 of count + 1 can not be merged with others, previous plan and progress must stay
+            other_path = os.path.join(workdir, 'other')
+            subprocess.check_call(cleaner + ['--plan', other_path, '--shard', '1/%d' % (count + 1)],
+                                  env=env, stdout=devnull)
+            with open(merged_path + '.done', 'w') as f:
+                f.write('1')
+            code = subprocess.call(cleaner + ['--plan', merged_path, '--merge', shard_paths[0], other_path],
+                                   env=env, stdout=devnull, stderr=devnull)
+            if code == 0:
+                failures.append('plans of different number of shards were merged')
+            if _entries(merged_path) != merged or not os.path.exists(merged_path + '.done'):
+                failures.append('failed merge replaced previous plan or its progress')
+            if [name for name in os.listdir(workdir) if name.endswith('.tmp')]:
+                failures.append('failed merge left temporary plan')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {
+        'shards': count,
+        'entries': len(expected),
+        'unsharded_time': unsharded_time,
+        'sharded_time': sharded_time,
+        'failures': failures,
+    }
+
+
+def compare(old, new):
+    """
+    Print relative change of numbers between two results
+    """
+    old_phases = dict((phase['phase'], phase) for phase in old['phases'])
+    for phase in new['phases']:
+        before = old_phases.get(phase['phase'])
+        if before is None:
+            continue
+        numbers = [(key, before[key], phase[key]) for key in ('wall_time', 'peak_rss_kb')]
+        numbers += [(name, seconds, phase.get('metrics', {}).get('phases', {}).get(name, 0.0))
+                    for name, seconds in sorted(before.get('metrics', {}).get('phases', {}).iteritems())]
+        for key, old_value, new_value in numbers:
+            if old_value:
+                print '%-20s %-12s %10.3f -> %10.3f (%+.1f%%)' % (phase['phase'], key, old_value, new_value,
+                                                                (new_value - old_value) * 100.0 / old_value)
+        for group in ('aptly_calls', 'fs_calls', 'syscalls'):
+            for key in sorted(set(before[group]) | set(phase[group])):
+                print '%-20s %-12s %10d -> %10d' % (phase['phase'], key, before[group].get(key, 0),
+                                                    phase[group].get(key, 0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packages', type=int, default=200, help='Number of packages')
+    parser.add_argument('--versions', type=int, default=30, help='Number of versions of each package')
+    parser.add_argument('--subdirs', type=int, default=4, help='Number of subdirs in each search dir')
+    parser.add_argument('--repos', type=int, default=10, help='Number of repos')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Passed to cleaners as --jobs')
+    parser.add_argument('--phases', default=','.join(PHASES), help='Comma separated phases to run')
+    parser.add_argument('-o', '--output', help='Write results to file instead of stdout')
+    parser.add_argument('--compare', metavar='OLD', help='Compare results with OLD results file')
+    parser.add_argument('--check-versions', type=int, metavar='COUNT', nargs='?', const=100000,
+                        help='Check version ordering against known dpkg results and measure sorting COUNT versions')
+    parser.add_argument('--check-api', action='store_true', help='Check API backend against stub of aptly API')
+    parser.add_argument('--check-shards', type=int, metavar='COUNT', nargs='?', const=4,
+                        help='Check that merged plans of COUNT shards equal plan of unsharded run')
+    parser.add_argument('--run-phase', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_phase:
+        result = run_phase(args.run_phase, args.workdir, args.jobs)
+        with open(args.result, 'w') as f:
+            json.dump(result, f)
+        sys.exit(0)
+
+    if args.check_versions:
+        result = check_versions(args.check_versions)
+        print json.dumps(result, indent=2, sort_keys=True)
+        sys.exit(1 if result['failures'] else 0)
+
+    if args.check_api:
+        result = check_api()
+        print json.dumps(result, indent=2, sort_keys=True)
+        sys.exit(1 if result['failures'] else 0)
+
+    if args.check_shards:
+        result = check_shards(args.check_shards, args)
+        print json.dumps(result, indent=2, sort_keys=True)
+        sys.exit(1 if result['failures'] else 0)
+
+    results = run(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(results, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
@@ -1,12 +1,27 @@
-import configobj
-import StringIO
-from validate import Validator
+import collections
+import marshal
+import os
+import zlib
+
+# Rules of one repo status, compiled from config
+Policy = collections.namedtuple('Policy', ['status', 'priority', 'days_to_live', 'max_packages', 'reference_only',
+                                           'distribution', 'repo_list'])
+
+# { config_path: (cache_key, compiled config) }, so reloads of unchanged config are free
+_compiled = {}
 
 
 class Config(object):
     _def_conf = '''
     [repo_info]
     aptly_url = string(default='http://localhost:8081/api')
+    aptly_backend = option('cli', 'api', default='cli')
+    remove_batch_size = integer(min=1, default=100)
+    aptly_root = string(default=None)
+    cache_file = string(default=None)
+    delete_jobs = integer(min=1, default=1)
+    delete_rate_files = float(min=0, default=0)
+    delete_rate_mb = float(min=0, default=0)
     run_user = string(default=None)
     search_dirs = list()
     [repos]
@@ -18,9 +33,31 @@ class Config(object):
         distribution = string(default='wheezy')
         repo_list = list()
     '''
+    _format = 1
 
     def __init__(self, conf_path):
         self._path = conf_path
+        compiled = self._load(conf_path)
+
+        self._repo_info = compiled['repo_info']
+        # { status: Policy }
+        self.policies = dict((rules[0], Policy(*rules)) for rules in compiled['repos'])
+        # Sorted by priority, higher priority == earlier in list
+        self._statuses = sorted(((policy.priority, status) for status, policy in self.policies.iteritems()),
+                                reverse=True)
+
+    @staticmethod
+    def _compile(conf_path):
+        """
+        Validate config against spec
+        :param conf_path: Path to config
+        :return: dict with 'repo_info' values and 'repos' as list of tuples of Policy fields
+        """
+        # Only needed when config changed, so not imported by runs that use cached config
+        import configobj
+        import StringIO
+        from validate import Validator
+
         def_conf = configobj.ConfigObj(configspec=StringIO.StringIO(Config._def_conf), interpolation=False)
 
         try:
@@ -38,57 +75,127 @@ class Config(object):
                     "/".join(section), key, error)
                 raise configobj.ConfigObjError(message)
 
-        self.conf = def_conf
-        self.repos = def_conf['repos']
-
-        self._cache = {
-            'statuses': list()
+        repos = []
+        for status, rules in def_conf['repos'].iteritems():
+            repos.append((status,) + tuple(rules[field] for field in Policy._fields[1:-1]) +
+                         (tuple(rules['repo_list']),))
+        return {
+            'repo_info': dict(def_conf['repo_info']),
+            'repos': repos,
         }
 
-    # def get_aptly_url(self):
-    #     return self.conf['repo_info']['aptly_url']
+    @staticmethod
+    def _cache_path(conf_path):
+        cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+        return os.path.join(cache_dir, 'aptly_cleaner', 'config-{0:08x}.cache'.format(
+            zlib.crc32(conf_path) & 0xffffffff))
+
+    @staticmethod
+    def _load(conf_path):
+        """
+        Get compiled config, from cache if config file did not change since it was compiled
+        :param conf_path: Path to config
+        :return: Compiled config, as returned by _compile()
+        """
+        conf_path = os.path.abspath(conf_path)
+        try:
+            info = os.stat(conf_path)
+        except OSError:
+            # Let configobj report missing config
+            return Config._compile(conf_path)
+        key = (Config._format, marshal.version, zlib.crc32(Config._def_conf), conf_path, info.st_mtime, info.st_size)
+
+        cached = _compiled.get(conf_path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        cache_path = Config._cache_path(conf_path)
+        try:
+            with open(cache_path, 'rb') as f:
+                cached_key, compiled = marshal.load(f)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            cached_key, compiled = None, None
+        if cached_key != key:
+            compiled = Config._compile(conf_path)
+            Config._save(cache_path, key, compiled)
+
+        _compiled[conf_path] = (key, compiled)
+        return compiled
+
+    @staticmethod
+    def _save(cache_path, key, compiled):
+        # Cache is only a speedup, so run does not fail if it can not be written
+        tmp_path = '{0}.{1}.tmp'.format(cache_path, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(cache_path)):
+                os.makedirs(os.path.dirname(cache_path))
+            with open(tmp_path, 'wb') as f:
+                marshal.dump((key, compiled), f)
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError):
+            pass
+
+    def get_aptly_url(self):
+        return self._repo_info['aptly_url']
+
+    def get_aptly_backend(self):
+        return self._repo_info['aptly_backend']
+
+    def get_remove_batch_size(self):
+        return self._repo_info['remove_batch_size']
+
+    def get_aptly_root(self):
+        return self._repo_info['aptly_root']
+
+    def get_cache_file(self):
+        return self._repo_info['cache_file']
+
+    def get_delete_jobs(self):
+        return self._repo_info['delete_jobs']
+
+    def get_delete_rate_files(self):
+        return self._repo_info['delete_rate_files']
+
+    def get_delete_rate_mb(self):
+        return self._repo_info['delete_rate_mb']
 
     def get_run_user(self):
-        return self.conf['repo_info']['run_user']
+        return self._repo_info['run_user']
 
     def get_glob_search_dirs(self):
-        return self.conf['repo_info']['search_dirs']
+        return self._repo_info['search_dirs']
 
     def get_statuses(self):
         """
-        Get/create list of statuses sorted by their priority
+        Get list of statuses sorted by their priority
         Higher priority == earlier in list
         :return:  Tuple (priority, status)
         """
-        if not self._cache['statuses']:
-            self._cache['statuses'] = [(self.get_param_by_status(st, 'priority'), st) for st in self.repos.keys()]
-            self._cache['statuses'].sort(reverse=True)
+        return self._statuses
 
-        return self._cache['statuses']
-
-    def get_param_by_status(self, status, param):
+    def policy(self, status):
+        """
+        :param status: Repo status
+        :return: Policy of status
+        """
         try:
-            return self._cache[status + "." + param]
+            return self.policies[status]
         except KeyError:
-            if status not in self.repos:
-                raise KeyError('"{0}" not in repo statuses'.format(status))
-
-            if param not in self.repos[status]:
-                raise KeyError('Param "{0}" not in repo params'.format(param))
+            raise KeyError('"{0}" not in repo statuses'.format(status))
 
-            self._cache[status + "." + param] = self.repos[status][param]
-            return self._cache[status + "." + param]
+    def get_param_by_status(self, status, param):
+        if param not in Policy._fields:
+            raise KeyError('Param "{0}" not in repo params'.format(param))
+        return getattr(self.policy(status), param)
 
     def get_days_to_live(self, status):
-        return self.get_param_by_status(status, 'days_to_live')
+        return self.policy(status).days_to_live
 
     def get_max_packages(self, status):
-        return self.get_param_by_status(status, 'max_packages')
+        return self.policy(status).max_packages
 
     def get_repos_by_status(self, status):
-        if status not in self.repos:
-            raise KeyError('"{0}" not in repo statuses'.format(status))
-        return self.repos[status]['repo_list']
+        return self.policy(status).repo_list
 
     def get_repos_all(self):
         """
@@ -0,0 +1,124 @@
+"""
+Debian package versions ordering, as done by dpkg
+"""
+
+# { version: key }, versions repeat a lot between repos and runs of matching
+_keys = {}
+
+
+def split_version(version):
+    """
+    Split version to its parts
+    :param version: Version, ex: '1:2.30-1ubuntu1'
+    :return: Tuple (epoch, upstream_version, debian_revision)
+    """
+    epoch, upstream = 0, version
+    if ':' in version:
+        text, rest = version.split(':', 1)
+        if text.isdigit():
+            epoch, upstream = int(text), rest
+    revision = ''
+    if '-' in upstream:
+        upstream, revision = upstream.rsplit('-', 1)
+    return epoch, upstream, revision
+
+
+def _order(char):
+    if char == '~':
+        return -1
+    if char.isdigit():
+        return 0
+    if char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+
+def _verrevcmp(a, b):
+    # Port of verrevcmp() from dpkg lib/dpkg/version.c
+    i, j = 0, 0
+    while i < len(a) or j < len(b):
+        first_diff = 0
+        while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+            ac = _order(a[i]) if i < len(a) else 0
+            bc = _order(b[j]) if j < len(b) else 0
+            if ac != bc:
+                return ac - bc
+            i += 1
+            j += 1
+        while i < len(a) and a[i] == '0':
+            i += 1
+        while j < len(b) and b[j] == '0':
+            j += 1
+        while i < len(a) and a[i].isdigit() and j < len(b) and b[j].isdigit():
+            if not first_diff:
+                first_diff = ord(a[i]) - ord(b[j])
+            i += 1
+            j += 1
+        if i < len(a) and a[i].isdigit():
+            return 1
+        if j < len(b) and b[j].isdigit():
+            return -1
+        if first_diff:
+            return first_diff
+    return 0
+
+
+def compare(a, b):
+    """
+    Compare two versions as dpkg --compare-versions does
+    :return: Negative if a is older than b, 0 if they are equal, positive if a is newer
+    """
+    a_epoch, a_upstream, a_revision = split_version(a)
+    b_epoch, b_upstream, b_revision = split_version(b)
+    if a_epoch != b_epoch:
+        return a_epoch - b_epoch
+    return _verrevcmp(a_upstream, b_upstream) or _verrevcmp(a_revision, b_revision)
+
+
+# Key of missing part: empty non-digit part and zero
+_END = ((0,), 0)
+
+
+def _part_key(text):
+    """
+    Build key for upstream version or revision, comparing keys gives the same result as _verrevcmp()
+    """
+    key = []
+    i, length = 0, len(text)
+    # First pair is built even for empty text, so '' and '0' have equal keys
+    while i < length or not key:
+        start = i
+        while i < length and not text[i].isdigit():
+            i += 1
+        # End of non-digit part is 0, so '~' (-1) sorts before end and everything else after
+        key.append(tuple(_order(char) for char in text[start:i]) + (0,))
+        start = i
+        while i < length and text[i].isdigit():
+            i += 1
+        key.append(int(text[start:i] or 0))
+    # Only first non-digit part can be empty, so this sorts shorter keys as dpkg does with missing parts
+    key.extend(_END)
+    return tuple(key)
+
+
+def version_key(version):
+    """
+    Sort key of version, keys are computed once for every version
+    :param version: Version, ex: '1:2.30-1ubuntu1'
+    :return: Key, comparing keys of versions gives the same result as compare()
+    """
+    key = _keys.get(version)
+    if key is None:
+        epoch, upstream, revision = split_version(version)
+        key = _keys[version] = (epoch, _part_key(upstream), _part_key(revision))
+    return key
+
+
+def sort_versions(versions):
+    """
+    Sort versions in place, from oldest to newest
+    :param versions: List of versions
+    :return: versions
+    """
+    versions.sort(key=version_key)
+    return versions
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+import Queue
+
+
+class RateLimiter(object):
+    """
+    Spreads amounts evenly in time, so their rate is not above limit
+    """
+
+    def __init__(self, rate):
+        """
+        :param rate: Max amount per second, 0 for no limit
+        """
+        self._rate = float(rate)
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self, amount=1):
+        if not self._rate:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + amount / self._rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class Deleter(object):
+    """
+    Removes files from FS on background threads, with limited rate.
+    Failures are collected and returned by close()
+    """
+
+    def __init__(self, jobs=1, files_per_second=0, mb_per_second=0, metrics=None):
+        """
+        :param jobs: Number of files removed at once
+        :param files_per_second: Max number of files removed per second, 0 for no limit
+        :param mb_per_second: Max MBs of files removed per second, 0 for no limit
+        :param metrics: metrics.Metrics to count removed files and bytes in
+        """
+        self._jobs = max(jobs, 1)
+        self._files_limit = RateLimiter(files_per_second)
+        self._bytes_limit = RateLimiter(mb_per_second * 1024 * 1024)
+        self._metrics = metrics
+        # Bounded, so matching does not run too far ahead of removal
+        self._queue = Queue.Queue(maxsize=self._jobs * 128)
+        self._threads = []
+        self._lock = threading.Lock()
+        # [(file_path, error)]
+        self.failed = []
+        self.removed = 0
+
+    def _start(self):
+        for _ in range(self._jobs):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._remove(*item)
+            finally:
+                self._queue.task_done()
+
+    def _remove(self, path, size):
+        self._files_limit.wait()
+        self._bytes_limit.wait(size)
+        try:
+            os.remove(path)
+        except OSError as e:
+            with self._lock:
+                self.failed.append((path, e.strerror or str(e)))
+            return
+        with self._lock:
+            self.removed += 1
+        if self._metrics:
+            self._metrics.count('files_removed')
+            self._metrics.count('bytes_freed', size)
+
+    def submit(self, path, size):
+        """
+        Queue file for removal. Blocks if queue is full
+        :param path: Path to file
+        :param size: File size, used for rate limit
+        """
+        if not self._threads:
+            self._start()
+        self._queue.put((path, size))
+
+    def wait(self):
+        """
+        Wait for all files queued so far to be removed, or to fail to
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Wait for all queued files to be removed
+        :return: List of tuples (file_path, error) for files that failed to be removed
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        return self.failed
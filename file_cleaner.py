@@ -1,117 +1,146 @@
 import argparse
 import os
-import glob
-import subprocess
+import threading
 from time import strftime
 
+import aptly_backend
 import config
+import deleter
+import fs_index
+import metrics
+import repo_snapshot
+import repo_store
+import scheduler
 
 
 class FileFinder(object):
 
-    def __init__(self, config_file, dry_run, remove, verbose):
+    def __init__(self, config_file, dry_run, remove, verbose, jobs=1, rebuild_cache=False, store=None, file_index=None,
+                 exclude=None, run_metrics=None):
+        """
+        :param store: repo_store.RepoStore shared with other tool, repos already in it are not queried.
+        Its cache file is saved by owner of store
+        :param file_index: fs_index.FileIndex of search dirs, orphans are found in it instead of walking search dirs
+        :param exclude: Set of file paths that are not orphans
+        :param run_metrics: metrics.Metrics shared with other tool
+        """
         self.conf = config.Config(config_file)
+        self._jobs = jobs
 
         self._not_dry_run = not dry_run
         self._remove = remove
-        self._cache = dict()
-
-        self._package_cache = set()
+        # Packages that are in any repo
+        self.store = store if store is not None else repo_store.RepoStore()
+        self.fs_index = file_index
+        self._exclude = exclude or set()
+        self._print_lock = threading.Lock()
 
         self._verbose = verbose
-
-    def _remove_file_from_fs(self, package):
+        self.metrics = run_metrics if run_metrics is not None else metrics.Metrics('file_cleaner')
+        self.backend = aptly_backend.make_backend(self.conf, lambda text: self._verbose_message(text, True), jobs,
+                                                  self.metrics)
+        self.snapshot = repo_snapshot.open_snapshot(self.conf, rebuild_cache) if store is None else None
+        self.deleter = deleter.Deleter(self.conf.get_delete_jobs(), self.conf.get_delete_rate_files(),
+                                       self.conf.get_delete_rate_mb(), self.metrics)
+
+    def _remove_file_from_fs(self, package, size):
         """
-        Remove files from FS by name(abs path)
+        Queue file for removal from FS by name(abs path)
         :param package: Path to package that should be deleted. Must be absolute(in terms of this class)
-        :return: None, pass on error
+        :param size: File size
+        :return: None, errors are reported by _report_fs_failures
         """
         if self._verbose:
             self._verbose_message("[%s] %s %s" % (self._remove_file_from_fs.__name__, "removed from fs", package))
 
-        try:
-            os.remove(package)
-        except OSError:
-            self._verbose_message("[%s] %s %s" % (self._remove_file_from_fs.__name__,
-                                                  "failed to remove from fs:", package), True)
-
-    def generate_package_cache(self, repo):
+        self.deleter.submit(package, size)
 
-        self._verbose_message("generating package cache for repo %s" % repo)
+    def _report_fs_failures(self):
+        failed = self.deleter.close()
+        for package, error in failed:
+            self._verbose_message("[%s] %s %s: %s" % (self._remove_file_from_fs.__name__,
+                                                      "failed to remove from fs", package, error), True)
+        if failed:
+            self._verbose_message("[{0}] {1}".format('do_all', 'files failed to remove from fs: %d' % len(failed)),
+                                  True)
 
-        repo_lines = str(subprocess.check_output(
-            "aptly repo search " + repo + " 'Name' | sort -V", shell=True))
-
-        repo_lines = repo_lines.splitlines()
-        if len(repo_lines) < 1:
-            raise ValueError('invalid response: {0}'.format(repo_lines))
-        # Set default name
-        packg = repo_lines[0].split("_")[0]
-        versions = []
-        arch = repo_lines[0].split("_")[2]
-        for line in repo_lines:
-            raw_pack = line.split("_")
-
-            if raw_pack[0] != packg:
-                if packg not in self._cache:
-                    self._cache[packg] = list()
-                self._cache[packg].append((arch, versions, repo))
+    def generate_package_cache(self, repo):
+        with self.metrics.phase('cache', repo=repo):
+            self._generate_package_cache(repo)
 
-                packg, arch = raw_pack[0], raw_pack[2]
-                versions = []
+    def _generate_package_cache(self, repo):
+        if self.store.has_repo(repo):
+            self._verbose_message("cache is already generated for repo %s" % repo)
+            return
 
-            versions.append(raw_pack[1])
+        packages = self.snapshot.get(repo) if self.snapshot else None
+        if packages is not None:
+            self._verbose_message("loaded package cache for repo %s from cache file" % repo)
+        else:
+            self._verbose_message("generating package cache for repo %s" % repo)
 
-        if packg not in self._cache:
-            self._cache[packg] = list()
+            packages = aptly_backend.read_packages(self.backend.search(repo))
+            if not packages:
+                raise ValueError('invalid response: no packages in repo {0}'.format(repo))
+            if self.snapshot:
+                self.snapshot.put(repo)
 
-        self._cache[packg].append((arch, versions, repo))
+        self.store.set_repo(repo, packages)
 
     def get_packages_in_dir(self, search_dir, deep_scan=True):
         """
-        Get files on FS in dir, with package_name
+        Get files on FS in dir that are not in any repo, while dir is walked
         :param search_dir: Directory to 'scan'
         :param deep_scan: If false - search only in dir/*.deb, else in dir/*/*.deb also
-        :return: None, set package cache
+        :return: Generator, items as tuple (file_path, size)
         """
-
-        for pckg_file in glob.iglob(os.path.join(search_dir, '*') + ".deb"):
-            self._package_cache.add(pckg_file)
-
-        if deep_scan:
-            for pckg_file in glob.iglob(os.path.join(search_dir, '*', '*') + ".deb"):
-                self._package_cache.add(pckg_file)
+        for entry, key in fs_index.iter_deb_entries(search_dir, deep_scan):
+            if self.store.contains(*key):
+                continue
+            try:
+                size = entry.stat().st_size
+            except OSError:
+                continue
+            self.metrics.count('files_stated')
+            yield entry.path, size
+
+    def get_orphans_in_index(self):
+        """
+        Get files in search dirs index that are not in any repo
+        :return: Generator, items as tuple (file_path, size)
+        """
+        for file_path, key, _, size in self.fs_index.iter_files():
+            if file_path not in self._exclude and not self.store.contains(*key):
+                yield file_path, size
 
     def is_in_cache(self, package_path):
-        _package_splitted = package_path.split('/')[-1].split('_')
-        package_name, package_version = _package_splitted[0], _package_splitted[1]
-
-        if package_name in self._cache:
-            for part in self._cache[package_name]:
-                if package_version in part[1]:
-                    return True
-        return False
+        key = fs_index.parse_deb_name(os.path.basename(package_path))
+        return key is not None and self.store.contains(*key)
 
     def do_all(self):
         # gen cache first, than do a search
+        repos = []
         for _, status in self.conf.get_statuses():
             # get repos from status
             for repo in self.conf.get_repos_by_status(status):
-                self.generate_package_cache(repo)
-
-        for search_dir in self.conf.get_glob_search_dirs():
-            self.get_packages_in_dir(search_dir)
+                if repo not in repos:
+                    repos.append(repo)
+        scheduler.run_jobs(self.generate_package_cache, repos, self._jobs)
+        if self.snapshot:
+            self.snapshot.save(self.store)
 
-        # get priority and statuses
         mb_spoiled = 0.0
-        for package_path in self._package_cache:
-            # get repos from status
-            if not self.is_in_cache(package_path):
-                mb_spoiled += os.stat(package_path).st_size / 1024 / 1024
-                self._verbose_message("[{0}] {1}".format('do_all/is_in_cache',
-                                                         'package ' + package_path + ' is not in cache'))
-                if self._not_dry_run and self._remove:
-                    self._remove_file_from_fs(package_path)
+        if self.fs_index is not None:
+            with self.metrics.phase('orphans'):
+                for package_path, size in self.get_orphans_in_index():
+                    mb_spoiled += self._handle_orphan(package_path, size)
+        else:
+            for search_dir in self.conf.get_glob_search_dirs():
+                # Orphans are handled while dir is walked, so all its files are never held in memory
+                with self.metrics.phase('fs_scan'):
+                    for package_path, size in self.get_packages_in_dir(search_dir):
+                        mb_spoiled += self._handle_orphan(package_path, size)
+        self._report_fs_failures()
 
         size = "MBs"
         if mb_spoiled > 1024.0:
@@ -119,18 +148,32 @@ class FileFinder(object):
             size = "GBs"
         self._verbose_message("[{0}] {1}".format('do_all', 'overall spoiled: %.3f %s' % (mb_spoiled, size)), True)
 
+    def _handle_orphan(self, package_path, size):
+        """
+        Report orphan and remove it if asked
+        :return: Size of orphan in MBs
+        """
+        self.metrics.count('orphans_found')
+        self._verbose_message("[{0}] {1}".format('do_all/is_in_cache', 'package ' + package_path + ' is not in cache'))
+        if self._not_dry_run and self._remove:
+            self._remove_file_from_fs(package_path, size)
+        return size / 1024.0 / 1024
+
     def _verbose_message(self, text, force=False):
         if not self._verbose and not force:
             return
 
-        print strftime("[%Y/%m/%d %H:%M:%S]"), text
+        with self._print_lock:
+            print strftime("[%Y/%m/%d %H:%M:%S]"), text
 
 
 def main(args):
-    finder = FileFinder(args.config, args.dry_run, args.remove, args.verbose)
+    if args.profile:
+        import profiler
+        profiler.start(args.profile, args.profile_mode, args.profile_interval)
+    finder = FileFinder(args.config, args.dry_run, args.remove, args.verbose, args.jobs, args.rebuild_cache)
     finder.do_all()
-
-    pass
+    finder.metrics.write(args.metrics_json, args.metrics_textfile)
 
 
 if __name__ == "__main__":
@@ -140,5 +183,18 @@ if __name__ == "__main__":
     parser.add_argument('-r', '--remove', action='store_true', default=False,
                         help='Remove all packages that are not in repos')
     parser.add_argument('--dry-run', action='store_true', default=False, help="Don't actually remove packages")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of repos to query concurrently')
+    parser.add_argument('--rebuild-cache', action='store_true', default=False,
+                        help='Query all repos from aptly, ignoring cache file')
+
+    parser.add_argument('--metrics-json', metavar='PATH', help='Write timings and counters of run to PATH as JSON')
+    parser.add_argument('--metrics-textfile', metavar='PATH',
+                        help='Write timings and counters of run to PATH in node_exporter textfile format')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Profile run, write PATH.pstats, PATH.collapsed stacks for flamegraphs and PATH.json')
+    parser.add_argument('--profile-mode', choices=('cprofile', 'sample'), default='cprofile',
+                        help="'cprofile' profiles every call, 'sample' only samples stacks, with low overhead")
+    parser.add_argument('--profile-interval', type=float, default=0.01, metavar='SECONDS',
+                        help='Seconds between stack samples of --profile')
 
     main(parser.parse_args())
@@ -0,0 +1,213 @@
+import glob
+import os
+import stat
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class _Entry(object):
+    """
+    Minimal os.DirEntry replacement for systems without scandir
+    """
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    def is_dir(self):
+        try:
+            return stat.S_ISDIR(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_file(self):
+        try:
+            return stat.S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+
+
+def _scandir(directory):
+    if scandir is not None:
+        return scandir(directory)
+    return (_Entry(directory, name) for name in os.listdir(directory))
+
+
+def parse_deb_name(file_name):
+    """
+    Split deb file name to its parts
+    :param file_name: File name. ex: 'google-chrome-stable_50.0.0_amd64.deb'
+    :return: Tuple (name, version, arch), None if file is not a deb package
+    """
+    if not file_name.endswith('.deb'):
+        return None
+    parts = file_name[:-4].split('_')
+    if len(parts) != 3:
+        return None
+    return parts[0], parts[1], parts[2]
+
+
+def iter_deb_entries(search_dir, deep_scan=True, expand=True):
+    """
+    Walk over deb packages in search_dir without stat'ing them
+    :param search_dir: Directory to 'scan', can be a glob pattern
+    :param deep_scan: If false - search only in dir/*.deb, else in dir/*/*.deb also
+    :param expand: Expand search_dir as glob pattern, otherwise it is a literal path
+    :return: Generator, items as tuple (dir_entry, (name, version, arch))
+    """
+    search_dirs = glob.glob(search_dir) if expand and glob.has_magic(search_dir) else [search_dir]
+    for directory in search_dirs:
+        for item in _iter_dir_entries(directory, deep_scan):
+            yield item
+
+
+def _iter_dir_entries(directory, deep_scan):
+    sub_dirs = []
+    try:
+        entries = _scandir(directory)
+    except OSError:
+        return
+    for entry in entries:
+        key = parse_deb_name(entry.name)
+        if key is not None:
+            yield entry, key
+        elif deep_scan:
+            # Without scandir support each is_dir() is a stat, so only non-deb entries are checked
+            try:
+                if entry.is_dir():
+                    sub_dirs.append(entry.path)
+            except OSError:
+                pass
+
+    if deep_scan:
+        # Found subdirs are literal paths, even if their names look like glob patterns
+        for sub_dir in sub_dirs:
+            for item in _iter_dir_entries(sub_dir, False):
+                yield item
+
+
+def iter_debs(search_dir, deep_scan=True, accept=None, expand=True):
+    """
+    Walk over deb packages in search_dir, stat'ing each of them once
+    :param search_dir: Directory to 'scan', can be a glob pattern
+    :param deep_scan: If false - search only in dir/*.deb, else in dir/*/*.deb also
+    :param accept: Callable taking (name, version, arch), packages it returns false for are skipped without stat
+    :param expand: Expand search_dir as glob pattern, otherwise it is a literal path
+    :return: Generator, items as tuple (file_path, (name, version, arch), mtime, size)
+    """
+    for entry, key in iter_deb_entries(search_dir, deep_scan, expand):
+        if accept is not None and not accept(key):
+            continue
+        try:
+            entry_stat = entry.stat()
+        except OSError:
+            continue
+        yield entry.path, key, entry_stat.st_mtime, entry_stat.st_size
+
+
+class FileIndex(object):
+    """
+    Index of deb packages in search dirs
+    """
+
+    def __init__(self):
+        # {
+        #     (name, version, arch): [(file_path, mtime, size)]
+        # }
+        self._index = {}
+
+    def scan(self, search_dir, deep_scan=True, accept=None, expand=True):
+        """
+        Add all packages from search_dir to index
+        :param search_dir: Directory to 'scan', can be a glob pattern
+        :param deep_scan: If false - search only in dir/*.deb, else in dir/*/*.deb also
+        :param accept: Callable taking (name, version, arch), packages it returns false for are not added
+        :param expand: Expand search_dir as glob pattern, otherwise it is a literal path
+        :return: Number of found packages
+        """
+        found = 0
+        for file_path, key, mtime, size in iter_debs(search_dir, deep_scan, accept, expand):
+            self._index.setdefault(key, []).append((file_path, mtime, size))
+            found += 1
+        return found
+
+    def add(self, file_path):
+        """
+        Add or update one file in index
+        :param file_path: Path to file
+        :return: True if file is a deb package and was added
+        """
+        key = parse_deb_name(os.path.basename(file_path))
+        if key is None:
+            return False
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            return False
+        self.discard(file_path)
+        self._index.setdefault(key, []).append((file_path, file_stat.st_mtime, file_stat.st_size))
+        return True
+
+    def discard(self, file_path):
+        """
+        Remove one file from index, if it is there
+        :param file_path: Path to file
+        :return: None
+        """
+        key = parse_deb_name(os.path.basename(file_path))
+        files = self._index.get(key)
+        if not files:
+            return
+        files = [info for info in files if info[0] != file_path]
+        if files:
+            self._index[key] = files
+        else:
+            del self._index[key]
+
+    def discard_dir(self, directory):
+        """
+        Remove all files in directory from index
+        :param directory: Path to directory
+        :return: None
+        """
+        prefix = directory.rstrip(os.sep) + os.sep
+        for key in self._index.keys():
+            files = [info for info in self._index[key] if not info[0].startswith(prefix)]
+            if files:
+                self._index[key] = files
+            else:
+                del self._index[key]
+
+    def clear(self):
+        self._index = {}
+
+    def iter_files(self):
+        """
+        Walk over all files in index
+        :return: Generator, items as tuple (file_path, (name, version, arch), mtime, size)
+        """
+        for key, files in self._index.iteritems():
+            for file_path, mtime, size in files:
+                yield file_path, key, mtime, size
+
+    def get(self, name, version, arch):
+        """
+        Get files of package version
+        :return: List of tuples (file_path, mtime, size)
+        """
+        return self._index.get((name, version, arch), [])
+
+    def __len__(self):
+        return len(self._index)
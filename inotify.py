@@ -0,0 +1,92 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event without name: wd, mask, cookie, len
+_EVENT = struct.Struct('iIII')
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return result
+
+
+class Inotify(object):
+    """
+    Linux inotify instance, read without blocking
+    """
+
+    def __init__(self):
+        libc = _get_libc()
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not supported on this system')
+        self._libc = libc
+        self._fd = _check(libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC))
+
+    def fileno(self):
+        return self._fd
+
+    def add_watch(self, path, mask):
+        """
+        :param path: Path to watch
+        :param mask: IN_* events to watch for
+        :return: Watch descriptor
+        """
+        return _check(self._libc.inotify_add_watch(self._fd, path, mask))
+
+    def rm_watch(self, wd):
+        _check(self._libc.inotify_rm_watch(self._fd, wd))
+
+    def read(self):
+        """
+        Read all pending events
+        :return: List of tuples (wd, mask, cookie, name)
+        """
+        events = []
+        while True:
+            try:
+                data = os.read(self._fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return events
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                events.append((wd, mask, cookie, name))
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
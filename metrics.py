@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics(object):
+    """
+    Durations of run phases and counters, written as JSON or as node_exporter textfile.
+    Time of nested phase is not counted in its parent phase
+    """
+
+    def __init__(self, prefix):
+        """
+        :param prefix: Prefix for metric names in textfile, ex: 'aptly_cleaner'
+        """
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._start = time.time()
+        # { phase: seconds }
+        self.phases = {}
+        # { phase: { repo: seconds } }
+        self.repo_phases = {}
+        # { counter: { label: value } }
+        self.counters = {}
+
+    @contextmanager
+    def phase(self, name, repo=None):
+        """
+        Measure duration of code block as phase
+        :param name: Phase name
+        :param repo: Also account duration for this repo
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        # Time spent in nested phases
+        stack.append(0.0)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.0) + elapsed - nested
+                if repo is not None:
+                    repos = self.repo_phases.setdefault(name, {})
+                    repos[repo] = repos.get(repo, 0.0) + elapsed - nested
+
+    def count(self, name, value=1, label=''):
+        """
+        Increase counter
+        :param name: Counter name
+        :param value: Value to add
+        :param label: Optional label, ex: aptly operation
+        """
+        with self._lock:
+            counter = self.counters.setdefault(name, {})
+            counter[label] = counter.get(label, 0) + value
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'wall_time': time.time() - self._start,
+                'phases': dict(self.phases),
+                'repo_phases': dict((phase, dict(repos)) for phase, repos in self.repo_phases.iteritems()),
+                'counters': dict((name, dict(values)) for name, values in self.counters.iteritems()),
+            }
+
+    @staticmethod
+    def _write(path, data):
+        # Written atomically, so node_exporter never reads half of file
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def write_json(self, path):
+        self._write(path, json.dumps(self.as_dict(), indent=2, sort_keys=True) + '\n')
+
+    def write_textfile(self, path):
+        data = self.as_dict()
+        prefix = self._prefix
+        lines = [
+            '# HELP {0}_run_seconds Duration of last run'.format(prefix),
+            '# TYPE {0}_run_seconds gauge'.format(prefix),
+            '{0}_run_seconds {1:.6f}'.format(prefix, data['wall_time']),
+            '# HELP {0}_last_run_timestamp_seconds Time last run finished'.format(prefix),
+            '# TYPE {0}_last_run_timestamp_seconds gauge'.format(prefix),
+            '{0}_last_run_timestamp_seconds {1:.3f}'.format(prefix, time.time()),
+            '# HELP {0}_phase_seconds Duration of run phase, without nested phases'.format(prefix),
+            '# TYPE {0}_phase_seconds gauge'.format(prefix),
+        ]
+        for phase, seconds in sorted(data['phases'].iteritems()):
+            lines.append('{0}_phase_seconds{{phase="{1}"}} {2:.6f}'.format(prefix, phase, seconds))
+
+        lines += [
+            '# HELP {0}_repo_phase_seconds Duration of run phase for repo'.format(prefix),
+            '# TYPE {0}_repo_phase_seconds gauge'.format(prefix),
+        ]
+        for phase, repos in sorted(data['repo_phases'].iteritems()):
+            for repo, seconds in sorted(repos.iteritems()):
+                lines.append('{0}_repo_phase_seconds{{phase="{1}",repo="{2}"}} {3:.6f}'.format(
+                    prefix, phase, repo, seconds))
+
+        for name, values in sorted(data['counters'].iteritems()):
+            metric = '{0}_{1}'.format(prefix, name)
+            lines.append('# TYPE {0} gauge'.format(metric))
+            for label, value in sorted(values.iteritems()):
+                labels = '{{op="{0}"}}'.format(label) if label else ''
+                lines.append('{0}{1} {2}'.format(metric, labels, value))
+        self._write(path, '\n'.join(lines) + '\n')
+
+    def write(self, json_path=None, textfile_path=None):
+        if json_path:
+            self.write_json(json_path)
+        if textfile_path:
+            self.write_textfile(textfile_path)
@@ -0,0 +1,160 @@
+import heapq
+import json
+import os
+
+
+class PlanWriter(object):
+    """
+    Writes cleanup plan as JSON lines, one package version to remove per line.
+    Plan is written to temporary file that replaces previous plan only when it is complete
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+        self._file = open(self._tmp_path, 'w')
+
+    def write(self, entry):
+        self._file.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    def close(self):
+        self._file.close()
+        os.rename(self._tmp_path, self._path)
+        # Plan is new, so progress of previous one does not apply to it
+        Checkpoint(self._path).clear()
+
+    def discard(self):
+        self._file.close()
+        os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+
+def read_plan(path):
+    """
+    Read plan line by line
+    :param path: Path to plan
+    :return: Generator, items as tuple (line_number, entry)
+    """
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if line.strip():
+                yield number, json.loads(line)
+
+
+def plan_shard(path):
+    """
+    :param path: Path to plan
+    :return: Shard plan was written by, as 'i/N', None if plan is empty or not sharded
+    """
+    for _, entry in read_plan(path):
+        return entry.get('shard')
+    return None
+
+
+def check_shards(paths):
+    """
+    Check that plans are of distinct shards of the same number of shards, by their first entries
+    :param paths: Paths to plans of shards
+    :return: None
+    """
+    # { shard: path }
+    shard_paths = {}
+    for path in paths:
+        shard = plan_shard(path)
+        if shard is None:
+            continue
+        if shard in shard_paths:
+            raise ValueError('shard {0} is in both {1} and {2}'.format(shard, shard_paths[shard], path))
+        shard_paths[shard] = path
+    if len(set(shard.split('/')[1] for shard in shard_paths)) > 1:
+        raise ValueError('plans are of different number of shards: {0}'.format(', '.join(sorted(shard_paths))))
+
+
+def merge_plans(paths, repos, writer):
+    """
+    Merge plans of shards into one, so all removals are applied by single run.
+    Entries of each repo are kept together, so they are removed in as few batches as possible.
+    Plans should be checked by check_shards() first
+    :param paths: Paths to plans of shards
+    :param repos: Repo names in order they are cleaned
+    :param writer: PlanWriter to write merged plan to
+    :return: Tuple (number of merged entries, sorted list of shards found in plans)
+    """
+    order = dict((repo, position) for position, repo in enumerate(repos))
+    # { shard: plan_number }
+    shard_plans = {}
+
+    def entries(plan_number, path):
+        for number, entry in read_plan(path):
+            shard = entry.get('shard')
+            if shard is not None and shard_plans.setdefault(shard, plan_number) != plan_number:
+                raise ValueError('shard {0} is in both {1} and {2}'.format(shard, paths[shard_plans[shard]], path))
+            # Plan of each shard is in order of repos already
+            yield (order.get(entry['repo'], len(order)), plan_number, number), entry
+
+    merged = 0
+    for _, entry in heapq.merge(*[entries(plan_number, path) for plan_number, path in enumerate(paths)]):
+        writer.write(entry)
+        merged += 1
+    return merged, sorted(shard_plans)
+
+
+class Checkpoint(object):
+    """
+    Number of plan lines that are already applied, kept next to plan, with lines among them that
+    failed to be removed, so they are retried by next apply.
+    Once repos are published and DB is cleaned up after all lines, plan is marked as published
+    """
+
+    def __init__(self, plan_path):
+        self._path = plan_path + '.done'
+        # Applied lines and failed lines among them of loaded checkpoint
+        self._done = 0
+        self._retry = set()
+
+    def load(self):
+        """
+        :return: Tuple (number of applied lines, set of applied lines to retry, True if plan is published)
+        """
+        try:
+            with open(self._path) as f:
+                fields = f.read().split()
+            number = self._done = int(fields[0]) if fields else 0
+            self._retry = set(int(line) for field in fields[1:] if field.startswith('retry=')
+                              for line in field[len('retry='):].split(','))
+        except (IOError, OSError, ValueError):
+            return 0, set(), False
+        return number, set(self._retry), 'published' in fields[1:]
+
+    def save(self, number, failed=(), published=False):
+        """
+        :param number: Number of last applied line, retried lines can be before lines applied already
+        :param failed: Lines failed to be removed by this apply
+        :param published: All lines are applied, repos are published and DB is cleaned up
+        :return: None
+        """
+        # Failed lines of loaded checkpoint after number are not retried yet
+        retry = sorted(set(line for line in self._retry if line > number) | set(failed))
+        fields = [str(max(number, self._done))]
+        if retry:
+            fields.append('retry=' + ','.join(str(line) for line in retry))
+        if published:
+            fields.append('published')
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(' '.join(fields))
+        os.rename(tmp_path, self._path)
+
+    def clear(self):
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
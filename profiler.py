@@ -0,0 +1,219 @@
+import atexit
+import cProfile
+import json
+import os
+import pstats
+import sys
+import thread
+import threading
+import time
+
+import aptly_backend
+
+# Callers of builtins that wait for aptly: running `aptly` and reading its output, or talking to aptly API
+_APTLY_FILES = ('subprocess.py', 'aptly_backend.py', 'httplib.py', 'socket.py', 'ssl.py')
+_APTLY_BUILTINS = ('fork', 'fork_exec', 'read', 'readline', 'readinto', 'recv', 'recv_into', 'waitpid', 'select',
+                   'poll', 'connect', 'send', 'sendall')
+# Builtins that are filesystem syscalls, whoever calls them
+_FS_BUILTINS = ('stat', 'lstat', 'listdir', 'scandir', 'remove', 'unlink', 'rmdir', 'rename', 'utime', 'access',
+                'readlink', 'is_dir', 'is_file', 'is_symlink', 'statvfs')
+# Sampled stack is waiting on filesystem if it stops in one of these
+_FS_FILES = ('fs_index.py', 'deleter.py', 'os.py', 'posixpath.py', 'genericpath.py', 'glob.py', 'scandir.py')
+# Background threads stopped in these are idle, waiting for work
+_IDLE_FILES = ('threading.py', 'Queue.py', 'pool.py')
+# Own time of these is reading `aptly` output, pipe is read by C iterator that cProfile does not see
+_APTLY_CODES = (aptly_backend.CliBackend.search.__func__.__code__,)
+
+
+def _builtin_name(name):
+    # '<posix.stat>' -> 'stat', "<method 'readline' of 'file' objects>" -> 'readline'
+    if name.startswith("<method '"):
+        return name.split("'")[1]
+    return name.strip('<>').split('.')[-1]
+
+
+def _frame_file(code):
+    return os.path.basename(code.co_filename)
+
+
+def _classify(codes):
+    """
+    :param codes: Code objects of sampled stack, from innermost
+    :return: 'aptly', 'fs' or None
+    """
+    leaf = codes[0]
+    if leaf in _APTLY_CODES:
+        return 'aptly'
+    for code in codes:
+        if _frame_file(code) in ('subprocess.py', 'httplib.py', 'socket.py', 'ssl.py'):
+            return 'aptly'
+    if _frame_file(leaf) in _FS_FILES:
+        return 'fs'
+    return None
+
+
+class Profiler(object):
+    """
+    Profiles run of a tool. Stacks of all threads are sampled and written in collapsed format for flamegraphs.
+    Unless only sampling, all threads are also profiled with cProfile, which is precise but slows run down.
+    Wall time spent waiting on aptly and in filesystem calls is reported separately, summed over threads.
+
+    Results are written next to path:
+    path.pstats - cProfile stats, read by `python -m pstats` or snakeviz
+    path.collapsed - sampled stacks, read by flamegraph.pl or speedscope
+    path.json - summary
+    """
+
+    def __init__(self, path, sample_only=False, interval=0.01):
+        """
+        :param path: Path prefix of result files
+        :param sample_only: Only sample stacks, low overhead mode that can be left on
+        :param interval: Seconds between stack samples
+        """
+        self._path = path
+        self._sample_only = sample_only
+        self._interval = interval
+        self._lock = threading.Lock()
+        # [(thread, cProfile.Profile)]
+        self._profiles = []
+        # { stack as tuple of code objects from innermost: seconds }
+        self._stacks = {}
+        # { 'aptly' / 'fs': seconds }
+        self._sampled = {'aptly': 0.0, 'fs': 0.0}
+        self._samples = 0
+        self._running = False
+        self._sampler = None
+        self._main = None
+        self._start = None
+
+    def start(self):
+        self._start = time.time()
+        self._main = thread.get_ident()
+        self._running = True
+        self._sampler = threading.Thread(target=self._sample)
+        self._sampler.daemon = True
+        self._sampler.start()
+        if not self._sample_only:
+            threading.setprofile(self._profile_thread)
+            self._profile_thread()
+
+    def _profile_thread(self, *args):
+        # Called by new threads on their first profiler event, replaces itself with cProfile
+        if threading.current_thread() is self._sampler:
+            sys.setprofile(None)
+            return
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append((threading.current_thread(), profile))
+        profile.enable()
+
+    def _sample(self):
+        own = thread.get_ident()
+        last = time.time()
+        while self._running:
+            time.sleep(self._interval)
+            now = time.time()
+            elapsed, last = now - last, now
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                codes = []
+                while frame is not None:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                codes = tuple(codes)
+                if ident != self._main and _frame_file(codes[0]) in _IDLE_FILES:
+                    continue
+                self._samples += 1
+                self._stacks[codes] = self._stacks.get(codes, 0.0) + elapsed
+                kind = _classify(codes)
+                if kind:
+                    self._sampled[kind] += elapsed
+
+    def _stats(self):
+        """
+        :return: pstats.Stats of all threads, None if nothing was profiled
+        """
+        profiles = []
+        for profiled_thread, profile in self._profiles:
+            # Stats of running thread would be read while it changes them
+            if profiled_thread is threading.current_thread() or not profiled_thread.is_alive():
+                profile.disable()
+                profiles.append(profile)
+        if not profiles:
+            return None
+        return pstats.Stats(*profiles)
+
+    @staticmethod
+    def _waits(stats):
+        """
+        Sum time spent in builtins that wait on aptly or filesystem, in all threads
+        :return: dict { 'aptly': seconds, 'fs': seconds }
+        """
+        waits = {'aptly': 0.0, 'fs': 0.0}
+        aptly_functions = set((code.co_filename, code.co_firstlineno, code.co_name) for code in _APTLY_CODES)
+        for (filename, line, name), (_, _, total_time, _, callers) in stats.stats.iteritems():
+            if (filename, line, name) in aptly_functions:
+                waits['aptly'] += total_time
+            if filename != '~':
+                continue
+            name = _builtin_name(name)
+            if name in _FS_BUILTINS:
+                waits['fs'] += total_time
+            elif name in _APTLY_BUILTINS:
+                waits['aptly'] += sum(caller_stats[2] for caller, caller_stats in callers.iteritems()
+                                      if os.path.basename(caller[0]) in _APTLY_FILES)
+        return waits
+
+    def _write_collapsed(self):
+        lines = []
+        for codes, seconds in self._stacks.iteritems():
+            stack = ';'.join('{0}:{1}'.format(_frame_file(code), code.co_name) for code in reversed(codes))
+            # Counted in milliseconds, as collapsed format needs integer counts
+            lines.append('{0} {1}'.format(stack, max(int(round(seconds * 1000)), 1)))
+        with open(self._path + '.collapsed', 'w') as f:
+            f.write('\n'.join(sorted(lines)) + '\n')
+
+    def stop(self):
+        """
+        Stop profiling and write results. Threads still running are not included in cProfile stats
+        """
+        if not self._running:
+            return
+        threading.setprofile(None)
+        self._running = False
+        self._sampler.join()
+        wall_time = time.time() - self._start
+
+        summary = {
+            'mode': 'sample' if self._sample_only else 'cprofile',
+            'wall_time': wall_time,
+            'interval': self._interval,
+            'samples': self._samples,
+            'waits_source': 'samples',
+            'waits': self._sampled,
+        }
+        stats = None if self._sample_only else self._stats()
+        if stats is not None:
+            stats.dump_stats(self._path + '.pstats')
+            # Timed per call, so it is exact, while samples are estimate
+            summary['waits_source'] = 'cprofile'
+            summary['waits'] = self._waits(stats)
+
+        self._write_collapsed()
+        with open(self._path + '.json', 'w') as f:
+            f.write(json.dumps(summary, indent=2, sort_keys=True) + '\n')
+
+
+def start(path, mode='cprofile', interval=0.01):
+    """
+    Profile rest of run, results are written at exit
+    :param path: Path prefix of result files
+    :param mode: 'cprofile' or 'sample'
+    :param interval: Seconds between stack samples
+    :return: Profiler
+    """
+    profiler = Profiler(path, mode == 'sample', interval)
+    profiler.start()
+    atexit.register(profiler.stop)
+    return profiler
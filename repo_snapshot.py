@@ -0,0 +1,120 @@
+import marshal
+import os
+
+import aptly_backend
+
+
+class RepoSnapshot(object):
+    """
+    On-disk copy of repo caches from previous run.
+    Repos are loaded from it only if aptly DB was not changed since run that saved it started, as number
+    of packages in repo stays the same when one version is replaced with another.
+    Durations of aptly operations from previous runs are kept too, to report time saved by skipping them
+    """
+    _format = 4
+
+    def __init__(self, path, aptly_root, rebuild=False):
+        """
+        :param path: Path to snapshot file
+        :param aptly_root: aptly root dir, its DB change marker is checked on load and kept on save
+        :param rebuild: Ignore existing snapshot
+        """
+        self._path = path
+        # Read before any repo is queried, so changes done while run goes, by it or not, invalidate snapshot
+        self._db_marker = aptly_backend.db_marker(aptly_root)
+        # Repos not yet loaded by this run, only if aptly DB did not change since snapshot
+        # { repo_name: { package_name: (arch, versions[]) } }
+        self._repos = {}
+        # Repos loaded or queried by this run, saved from repo_store.RepoStore
+        self._current = set()
+        # Copies of repos made before they were changed by dry run
+        # { repo_name: { package_name: (arch, versions[]) } }
+        self._copies = {}
+        # { operation: seconds }
+        self._timings = {}
+        if not rebuild:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self._path, 'rb') as f:
+                snapshot_format, marshal_version, db_marker, repos, timings = marshal.load(f)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return
+        if snapshot_format != RepoSnapshot._format or marshal_version != marshal.version:
+            return
+        self._timings = timings
+        if self._db_marker is not None and db_marker == self._db_marker:
+            self._repos = repos
+
+    def get(self, repo):
+        """
+        Get packages of repo if aptly DB did not change since snapshot.
+        Returned packages are not kept by snapshot, they are saved back from store
+        :param repo: Repo name
+        :return: dict { package_name: (arch, versions[]) }, None if repo must be re-queried
+        """
+        packages = self._repos.pop(repo, None)
+        if packages is not None:
+            self._current.add(repo)
+        return packages
+
+    def put(self, repo):
+        """
+        Mark repo as queried by this run
+        :param repo: Repo name
+        :return: None
+        """
+        self._current.add(repo)
+
+    def modified(self, repo, applied, store):
+        """
+        Mark repo as modified by this run. Must be called before repo is changed in store
+        :param repo: Repo name
+        :param applied: True if change was done in aptly. Otherwise snapshot keeps its own copy of repo
+        :param store: repo_store.RepoStore with repo
+        :return: None
+        """
+        if applied:
+            self._repos.pop(repo, None)
+            self._current.discard(repo)
+            self._copies.pop(repo, None)
+        elif repo in self._current and repo not in self._copies:
+            self._copies[repo] = store.export(repo)
+
+    def timing(self, operation):
+        """
+        :param operation: Operation name, ex: 'db_cleanup'
+        :return: Duration of operation when it was last done, None if unknown
+        """
+        return self._timings.get(operation)
+
+    def set_timing(self, operation, seconds):
+        self._timings[operation] = seconds
+
+    def save(self, store):
+        """
+        Save repos with DB marker read when run started. If aptly DB changed since then, next run
+        queries all repos again
+        :param store: repo_store.RepoStore with repos of this run
+        :return: None
+        """
+        repos = dict(self._repos)
+        for repo in self._current:
+            repos[repo] = self._copies[repo] if repo in self._copies else store.export(repo)
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            marshal.dump((RepoSnapshot._format, marshal.version, self._db_marker, repos, self._timings), f)
+        os.rename(tmp_path, self._path)
+
+
+def open_snapshot(conf, rebuild=False):
+    """
+    Open snapshot set in config
+    :param conf: config.Config
+    :param rebuild: Ignore existing snapshot
+    :return: RepoSnapshot, None if cache file is not set
+    """
+    if not conf.get_cache_file():
+        return None
+    return RepoSnapshot(conf.get_cache_file(), aptly_backend.aptly_root(conf.get_aptly_root()), rebuild)
@@ -0,0 +1,196 @@
+import threading
+from array import array
+
+
+class RepoStore(object):
+    """
+    Contents of all repos. Package names and versions are interned to integer ids once for all
+    repos, versions of package in repo are kept as array of ids, and every (package, version) and
+    (package, version, arch) has a bitmask of repos that hold it
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # { name: id }, [name]
+        self._name_ids = {}
+        self._names = []
+        # { version: id }, [version]
+        self._version_ids = {}
+        self._versions = []
+        # { archs: archs }, so equal arch lists are one string
+        self._archs = {}
+        # { arch: id }, [arch]
+        self._arch_ids = {}
+        self._arch_names = []
+        # { repo: bit }, [repo]
+        self._repo_bits = {}
+        self._repos = []
+        # {
+        #     repo_name: {
+        #         name_id: (archs, array(version_id), [archs of version])
+        #     }
+        # }
+        self._contents = {}
+        # { name_id << 32 | version_id: repos_bitmask }
+        self._holders = {}
+        # { (name_id << 32 | version_id) << 16 | arch_id: repos_bitmask }
+        self._arch_holders = {}
+
+    def register(self, repo):
+        """
+        Assign bit to repo
+        :param repo: Repo name
+        :return: Repo bit
+        """
+        with self._lock:
+            return self._register(repo)
+
+    def _register(self, repo):
+        bit = self._repo_bits.get(repo)
+        if bit is None:
+            bit = self._repo_bits[repo] = 1 << len(self._repos)
+            self._repos.append(repo)
+        return bit
+
+    def _intern(self, ids, values, value):
+        value_id = ids.get(value)
+        if value_id is None:
+            value_id = ids[value] = len(values)
+            values.append(value)
+        return value_id
+
+    @staticmethod
+    def _unset(holders, key, bit):
+        repos = holders.get(key, 0) & ~bit
+        if repos:
+            holders[key] = repos
+        else:
+            holders.pop(key, None)
+
+    def _arch_keys(self, key, archs):
+        return [key << 16 | self._intern(self._arch_ids, self._arch_names, arch) for arch in archs.split(',')]
+
+    def has_repo(self, repo):
+        return repo in self._contents
+
+    def set_repo(self, repo, packages):
+        """
+        Set contents of repo
+        :param repo: Repo name
+        :param packages: dict { package_name: (archs, versions[], version_archs[]) }, as read by
+        aptly_backend.read_packages
+        :return: None
+        """
+        with self._lock:
+            bit = self._register(repo)
+            contents = {}
+            for name, (archs, versions, version_archs) in packages.iteritems():
+                name_id = self._intern(self._name_ids, self._names, name)
+                version_ids = array('I', [self._intern(self._version_ids, self._versions, version)
+                                          for version in versions])
+                version_archs = [self._archs.setdefault(arch, arch) for arch in version_archs]
+                contents[name_id] = (self._archs.setdefault(archs, archs), version_ids, version_archs)
+                for version_id, arch in zip(version_ids, version_archs):
+                    key = name_id << 32 | version_id
+                    self._holders[key] = self._holders.get(key, 0) | bit
+                    for arch_key in self._arch_keys(key, arch):
+                        self._arch_holders[arch_key] = self._arch_holders.get(arch_key, 0) | bit
+            self._contents[repo] = contents
+
+    def drop(self, repo):
+        """
+        Forget contents of repo, so it is queried again
+        :param repo: Repo name
+        :return: None
+        """
+        with self._lock:
+            contents = self._contents.pop(repo, None)
+            if contents is None:
+                return
+            bit = self._repo_bits[repo]
+            for name_id, (_, version_ids, version_archs) in contents.iteritems():
+                for version_id, arch in zip(version_ids, version_archs):
+                    key = name_id << 32 | version_id
+                    self._unset(self._holders, key, bit)
+                    for arch_key in self._arch_keys(key, arch):
+                        self._unset(self._arch_holders, arch_key, bit)
+
+    def cached_repos(self):
+        """
+        :return: List of repos with contents
+        """
+        return list(self._contents)
+
+    def packages(self, repo):
+        """
+        Walk packages of repo
+        :param repo: Repo name
+        :return: Generator, items as tuple (package_name, archs, versions[])
+        """
+        versions = self._versions
+        for name_id, (archs, version_ids, _) in self._contents[repo].iteritems():
+            yield self._names[name_id], archs, [versions[version_id] for version_id in version_ids]
+
+    def export(self, repo):
+        """
+        :return: dict { package_name: (archs, versions[], version_archs[]) } of repo, as taken by set_repo
+        """
+        versions = self._versions
+        return dict((self._names[name_id], (archs, [versions[version_id] for version_id in version_ids],
+                                            list(version_archs)))
+                    for name_id, (archs, version_ids, version_archs) in self._contents[repo].iteritems())
+
+    def remove(self, repo, name, version):
+        """
+        Remove package version from repo
+        :return: None
+        """
+        name_id = self._name_ids[name]
+        version_id = self._version_ids[version]
+        with self._lock:
+            _, version_ids, version_archs = self._contents[repo][name_id]
+            index = version_ids.index(version_id)
+            del version_ids[index]
+            arch = version_archs.pop(index)
+            bit = self._repo_bits[repo]
+            key = name_id << 32 | version_id
+            self._unset(self._holders, key, bit)
+            for arch_key in self._arch_keys(key, arch):
+                self._unset(self._arch_holders, arch_key, bit)
+
+    def holders(self, name, version):
+        """
+        :return: Bitmask of repos that hold package version
+        """
+        name_id = self._name_ids.get(name)
+        version_id = self._version_ids.get(version)
+        if name_id is None or version_id is None:
+            return 0
+        return self._holders.get(name_id << 32 | version_id, 0)
+
+    def mask(self, repos):
+        """
+        :return: Bitmask of repos
+        """
+        mask = 0
+        for repo in repos:
+            mask |= self.register(repo)
+        return mask
+
+    def repos(self, mask):
+        """
+        :return: List of repos in bitmask
+        """
+        return [repo for repo in self._repos if mask & self._repo_bits[repo]]
+
+    def contains(self, name, version, arch):
+        """
+        Check if package version of arch is in any repo
+        :return: bool
+        """
+        name_id = self._name_ids.get(name)
+        version_id = self._version_ids.get(version)
+        arch_id = self._arch_ids.get(arch)
+        if name_id is None or version_id is None or arch_id is None:
+            return False
+        return ((name_id << 32 | version_id) << 16 | arch_id) in self._arch_holders
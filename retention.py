@@ -0,0 +1,48 @@
+import math
+
+SECONDS_IN_DAY = 60 * 60 * 24
+
+# numpy module, False if it is not installed, None until first needed
+_numpy = None
+
+
+def age_days(check_time, package_time):
+    """
+    :return: Full days passed from package_time to check_time
+    """
+    return math.floor((check_time - package_time) / SECONDS_IN_DAY)
+
+
+def _get_numpy():
+    # Imported on first use, so runs that do not match packages, ex: --control, do not import it.
+    # Failed import is not cached by Python, so result is kept to not search for numpy again
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+            _numpy = numpy
+        except ImportError:
+            _numpy = False
+    return _numpy
+
+
+def removable(check_time, mtimes, days_to_live):
+    """
+    Evaluate retention rules for batch of package versions at once.
+    Version can be removed if it is older than days_to_live full days. Newest max_packages versions
+    of package are always kept, so they are not passed here
+    :param check_time: Time to count age from, in seconds
+    :param mtimes: Sequence of last modification times of versions, in seconds
+    :param days_to_live: Days version is kept for
+    :return: List of indexes of removable versions, in order
+    """
+    if not mtimes:
+        return []
+    numpy = _get_numpy()
+    # Full days of age are above days_to_live exactly when version is not newer than this
+    latest = check_time - (days_to_live + 1) * SECONDS_IN_DAY
+    if numpy:
+        return numpy.flatnonzero(numpy.asarray(mtimes, dtype=numpy.float64) <= latest).tolist()
+
+    return [index for index, mtime in enumerate(mtimes) if mtime <= latest]
+
@@ -0,0 +1,21 @@
+def run_jobs(func, items, jobs=1):
+    """
+    Call func for every item, running at most `jobs` calls at once
+    :param func: Callable with one argument
+    :param items: List of arguments
+    :param jobs: Number of workers
+    :return: List of results, in order of items
+    """
+    items = list(items)
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    # Imported only when jobs are run concurrently, importing it is slow
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(jobs, len(items)))
+    try:
+        # get() with timeout keeps main thread interruptible by Ctrl+C
+        return pool.map_async(func, items, chunksize=1).get(1 << 31)
+    finally:
+        pool.terminate()
+        pool.join()
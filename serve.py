@@ -0,0 +1,352 @@
+import errno
+import glob
+import os
+import select
+import signal
+import socket
+import traceback
+from time import localtime, time, strftime
+
+import aptly_backend
+import aptly_cleaner
+import config
+import fs_index
+import inotify
+import repo_store
+
+# Seconds control client has to send its command, so silent client does not block events and cleanups
+_CLIENT_TIMEOUT = 5
+
+_DIR_EVENTS = (inotify.IN_CLOSE_WRITE | inotify.IN_CREATE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM |
+               inotify.IN_DELETE | inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF | inotify.IN_ONLYDIR)
+
+
+class SearchDirWatcher(object):
+    """
+    Keeps fs_index.FileIndex of search dirs up to date from inotify events.
+    Same dirs are watched as scanned by FileIndex.scan: search dir and, with deep scan, its subdirs
+    """
+
+    def __init__(self, index, search_dirs, message):
+        """
+        :param index: fs_index.FileIndex to update
+        :param search_dirs: Search dirs, can be glob patterns
+        :param message: Callable to report progress
+        """
+        self._index = index
+        self._search_dirs = search_dirs
+        self._message = message
+        self._inotify = inotify.Inotify()
+        # { wd: (dir_path, is_search_dir) }, { dir_path: wd }
+        self._watches = {}
+        self._watched = {}
+
+    def fileno(self):
+        return self._inotify.fileno()
+
+    def _watch(self, directory, is_search_dir):
+        try:
+            wd = self._inotify.add_watch(directory, _DIR_EVENTS)
+        except OSError as e:
+            self._message("failed to watch {0}: {1}".format(directory, e.strerror))
+            return False
+        previous = self._watches.get(wd)
+        if previous is not None:
+            # Same dir is watched under its new path
+            self._watched.pop(previous[0], None)
+        self._watches[wd] = (directory, is_search_dir)
+        self._watched[directory] = wd
+        return True
+
+    def _unwatch(self, wd):
+        """
+        Stop watching dir and remove its files from index. Subdirs of search dir are unwatched with it
+        :param wd: Watch descriptor of dir
+        :return: None
+        """
+        directory, is_search_dir = self._watches.pop(wd)
+        del self._watched[directory]
+        # Watch of moved dir stays in kernel, and would report events under old path
+        try:
+            self._inotify.rm_watch(wd)
+        except OSError:
+            pass
+        if is_search_dir:
+            prefix = directory.rstrip(os.sep) + os.sep
+            for sub_dir, sub_wd in self._watched.items():
+                if sub_dir.startswith(prefix):
+                    self._unwatch(sub_wd)
+        self._index.discard_dir(directory)
+
+    def _add_dir(self, directory, is_search_dir):
+        # Watch is added before dir is scanned, so files created meanwhile are not missed
+        if directory in self._watched or not self._watch(directory, is_search_dir):
+            return
+        if is_search_dir:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                names = []
+            for name in names:
+                sub_dir = os.path.join(directory, name)
+                if os.path.isdir(sub_dir):
+                    self._add_dir(sub_dir, False)
+        # Search dirs are already expanded, and subdirs are found on disk, so both are literal paths
+        found = self._index.scan(directory, deep_scan=False, expand=False)
+        self._message("found %d packages in %s" % (found, directory))
+
+    def refresh(self):
+        """
+        Watch search dirs that appeared since last call, ex: new matches of glob patterns
+        :return: None
+        """
+        for search_dir in self._search_dirs:
+            for directory in glob.glob(search_dir) if glob.has_magic(search_dir) else [search_dir]:
+                if os.path.isdir(directory):
+                    self._add_dir(directory, True)
+
+    def rescan(self):
+        """
+        Rebuild index from scratch
+        :return: None
+        """
+        for wd in self._watches.keys():
+            try:
+                self._inotify.rm_watch(wd)
+            except OSError:
+                pass
+        self._watches = {}
+        self._watched = {}
+        self._index.clear()
+        self.refresh()
+
+    def handle_events(self):
+        """
+        Apply pending inotify events to index
+        :return: Number of events handled
+        """
+        events = self._inotify.read()
+        for wd, mask, _, name in events:
+            if mask & inotify.IN_Q_OVERFLOW:
+                self._message("inotify queue overflow, rescanning search dirs")
+                self.rescan()
+                return len(events)
+            watch = self._watches.get(wd)
+            if watch is None:
+                continue
+            directory, is_search_dir = watch
+            if mask & (inotify.IN_IGNORED | inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF):
+                self._unwatch(wd)
+                continue
+            path = os.path.join(directory, name)
+            if mask & inotify.IN_ISDIR:
+                if is_search_dir and mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                    self._add_dir(path, False)
+                elif is_search_dir and mask & inotify.IN_MOVED_FROM:
+                    # Dir is watched again if it was moved to search dir, events of old watch are dropped
+                    if path in self._watched:
+                        self._unwatch(self._watched[path])
+                    else:
+                        self._index.discard_dir(path)
+            elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                self._index.discard(path)
+            else:
+                self._index.add(path)
+        return len(events)
+
+    def close(self):
+        self._inotify.close()
+
+
+class Server(object):
+    """
+    Keeps repo caches and search dirs index in memory and runs cleanups on schedule or
+    when asked through control socket.
+    Repos are queried again only if aptly DB changed since last cleanup started, as number of packages in repo
+    stays the same when one version is replaced with another
+    """
+
+    def __init__(self, config_file, socket_path, interval, verbose, dry_run, only_repo, jobs=1, metrics_json=None,
+                 metrics_textfile=None):
+        """
+        :param config_file: Path to config, read again for every cleanup
+        :param socket_path: Path to control socket
+        :param interval: Seconds between scheduled cleanups, 0 to clean only when asked
+        :param dry_run: Don't actually remove packages in any cleanup
+        """
+        self._config_file = config_file
+        self._socket_path = socket_path
+        self._interval = interval
+        self._verbose = verbose
+        self._dry_run = dry_run
+        self._only_repo = only_repo
+        self._jobs = jobs
+        self._metrics_json = metrics_json
+        self._metrics_textfile = metrics_textfile
+
+        self.conf = config.Config(config_file)
+        self.store = repo_store.RepoStore()
+        self.fs_index = fs_index.FileIndex()
+        self._aptly_root = aptly_backend.aptly_root(self.conf.get_aptly_root())
+        # DB marker read before last cleanup queried repos, store is known to match aptly while it is unchanged
+        self._db_marker = None
+        self.watcher = None
+        self._running = False
+        self._last_run = None
+
+    def _validate_store(self, cleaner):
+        """
+        Drop repos that changed in aptly since last cleanup, or are not in config anymore
+        :param cleaner: aptly_cleaner.AptCleaner of next cleanup
+        :return: DB marker read before any repo is queried, store matches aptly while it is unchanged
+        """
+        repos = set(repo for _, status in cleaner.conf.get_statuses()
+                    for repo in cleaner.conf.get_repos_by_status(status))
+        marker = aptly_backend.db_marker(self._aptly_root)
+        db_unchanged = marker is not None and marker == self._db_marker
+        if not db_unchanged and self.store.cached_repos():
+            self._verbose_message("aptly DB changed, repos will be queried again")
+        for repo in self.store.cached_repos():
+            if repo not in repos or not db_unchanged:
+                self.store.drop(repo)
+        return marker
+
+    def run_cleanup(self, dry_run):
+        """
+        Run one cleanup on resident caches. Failed cleanup is reported, server keeps running
+        :param dry_run: Don't actually remove packages
+        :return: Reply for control socket
+        """
+        try:
+            return self._run_cleanup(dry_run)
+        except Exception as e:
+            self._verbose_message("cleanup failed: %s" % traceback.format_exc().rstrip(), True)
+            return 'error cleanup failed: {0}: {1}'.format(type(e).__name__, str(e).replace('\n', ' '))
+
+    def _run_cleanup(self, dry_run):
+        dry_run = dry_run or self._dry_run
+        self.watcher.refresh()
+        self.watcher.handle_events()
+        start = time()
+        cleaner = aptly_cleaner.AptCleaner(self._config_file, self._verbose, dry_run, self._only_repo, False,
+                                           self._jobs, store=self.store, file_index=self.fs_index)
+        # Marker is reset first, so store is validated again next time if cleanup fails
+        self._db_marker = None
+        try:
+            marker = self._validate_store(cleaner)
+            removed, failed = cleaner.do_all_clean()
+        except Exception:
+            # Store follows removals, which may have not happened in aptly
+            for repo in cleaner.changed_repos:
+                self.store.drop(repo)
+            raise
+
+        failed_repos = set(repo for repo, _, _ in failed)
+        for repo in cleaner.changed_repos:
+            # Store follows removals, which did not happen in aptly on dry run or failure
+            if dry_run or repo in failed_repos:
+                self.store.drop(repo)
+        # Read before repos were queried, so changes done while cleanup went, by it or not, are found by next one
+        self._db_marker = marker
+        cleaner.metrics.write(self._metrics_json, self._metrics_textfile)
+
+        self._last_run = time()
+        return 'ok removed {0} failed {1} in {2:.3f}s'.format(removed, len(failed), self._last_run - start)
+
+    def status(self):
+        last_run = strftime('%Y/%m/%d-%H:%M:%S', localtime(self._last_run)) if self._last_run else 'never'
+        return 'ok repos {0} package_versions {1} last_run {2}'.format(len(self.store.cached_repos()),
+                                                                       len(self.fs_index), last_run)
+
+    def _handle_client(self, listener):
+        conn, _ = listener.accept()
+        try:
+            conn.settimeout(_CLIENT_TIMEOUT)
+            command = conn.makefile('r').readline().strip()
+            if command == 'clean':
+                reply = self.run_cleanup(False)
+            elif command == 'dry-run':
+                reply = self.run_cleanup(True)
+            elif command == 'status':
+                reply = self.status()
+            elif command == 'stop':
+                self.stop()
+                reply = 'ok stopping'
+            else:
+                reply = 'error unknown command {0!r}, expected clean, dry-run, status or stop'.format(command)
+            conn.sendall(reply + '\n')
+        except socket.error as e:
+            self._verbose_message("control connection failed: %s" % e, True)
+        finally:
+            conn.close()
+
+    def _listen(self):
+        try:
+            os.unlink(self._socket_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self._socket_path)
+        os.chmod(self._socket_path, 0o600)
+        listener.listen(5)
+        return listener
+
+    def stop(self, *_):
+        self._running = False
+
+    def serve_forever(self):
+        listener = self._listen()
+        signal.signal(signal.SIGTERM, self.stop)
+        self.watcher = SearchDirWatcher(self.fs_index, self.conf.get_glob_search_dirs(),
+                                        lambda text: self._verbose_message(text))
+        self.watcher.refresh()
+        self._verbose_message("listening on %s" % self._socket_path, True)
+
+        next_run = time() + self._interval if self._interval else None
+        self._running = True
+        try:
+            while self._running:
+                timeout = max(0.0, next_run - time()) if next_run is not None else None
+                try:
+                    readable, _, _ = select.select([self.watcher, listener], [], [], timeout)
+                except select.error as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if self.watcher in readable:
+                    self.watcher.handle_events()
+                if listener in readable:
+                    self._handle_client(listener)
+                if next_run is not None and time() >= next_run:
+                    self._verbose_message(self.run_cleanup(False), True)
+                    next_run = time() + self._interval
+        finally:
+            listener.close()
+            self.watcher.close()
+            try:
+                os.unlink(self._socket_path)
+            except OSError:
+                pass
+
+    def _verbose_message(self, text, force=False):
+        if not self._verbose and not force:
+            return
+
+        print strftime("[%Y/%m/%d %H:%M:%S]"), text
+
+
+def send_command(socket_path, command):
+    """
+    Send command to running server
+    :param socket_path: Path to control socket
+    :param command: One of clean, dry-run, status, stop
+    :return: Reply of server, starts with 'ok' on success and with 'error' on failure
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+        conn.sendall(command + '\n')
+        return conn.makefile('r').readline().strip() or 'error no reply from server'
+    finally:
+        conn.close()
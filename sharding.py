@@ -0,0 +1,36 @@
+import zlib
+
+
+class Shard(object):
+    """
+    Part of packages handled by one of several runs. Packages are split by name, so all versions
+    of a package in all repos are in the same shard and cross-priority matching stays complete
+    """
+
+    def __init__(self, index, count):
+        """
+        :param index: Shard number, from 1 to count
+        :param count: Number of shards
+        """
+        if count < 1 or not 1 <= index <= count:
+            raise ValueError('invalid shard {0}/{1}'.format(index, count))
+        self.index = index
+        self.count = count
+
+    @staticmethod
+    def parse(text):
+        """
+        :param text: Shard as 'i/N', ex: '2/4'
+        :return: Shard
+        """
+        try:
+            index, count = [int(part) for part in text.split('/')]
+        except ValueError:
+            raise ValueError('invalid shard {0!r}, expected i/N'.format(text))
+        return Shard(index, count)
+
+    def contains(self, package_name):
+        return (zlib.crc32(package_name) & 0xffffffff) % self.count == self.index - 1
+
+    def __str__(self):
+        return '{0}/{1}'.format(self.index, self.count)